@@ -1,18 +1,36 @@
 """ This file contains function and classes for the Artificial Intelligence used in the game.
 """
 
+import heapq
 import math
-from collections import defaultdict, deque
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy
 import pymunk
 from pymunk import Vec2d
 import gameobjects
-from numpy import transpose
+import maps
 
 # NOTE: use only 'map0' during development!
 
 MIN_ANGLE_DIF = math.radians(3)   # 3 degrees, a bit more than we can turn each tick
 MIN_XY_DIF = 0.05
+LOST_DISTANCE = 2  # Tiles between a tank and its next waypoint from which its path is found again
+
+# Cost of entering a tile for the weighted A* planner, by box type. Wood
+# boxes are crossed by shooting them and metal boxes by pushing them, rock
+# boxes (type 1) can not be crossed at all.
+TILE_COSTS = {maps.GRASS: 1, maps.WOOD: 4, maps.METAL: 8}
+
+SHOOTING_RANGE = 20  # Tiles, a bit less than a bullet flies during its lifetime
+SIGHT_HEADINGS = 16  # Number of directions the lines of sight are cached for
+MUZZLE = 0.4  # Distance from the center of a tank to where its bullets start
+QUERY_BURST = 2  # Number of segment queries an Ai can save up when it does not use them
+MAX_REPLANS_PER_TICK = 2  # Number of Ais of a match that may look for a new path during one tick
+PROCESS_PLANNING_TILES = 100 * 100  # Maps from this size up are planned on in processes rather than threads
 
 def angle_between_vectors(vec1, vec2):
     """ Since Vec2d operates in a cartesian coordinate space we have to
@@ -27,21 +45,532 @@ def periodic_difference_of_angles(angle1, angle2):
     """
     return (angle1 % (2 * math.pi)) - (angle2 % (2 * math.pi))
 
+
+class DistanceFieldCache:
+    """ Distance fields of one map, shared by every Ai playing on it.
+        A distance field holds, for every tile, the number of steps needed to
+        reach a target tile, so that the shortest path from any tile can be
+        read from it without searching again. Fields are kept for the
+        MAX_FIELDS most recently used targets and are all discarded when a box
+        of the map is destroyed or moved (that is when map.revision changes).
+    """
+
+    MAX_FIELDS = 64
+
+    _caches = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_map(cls, currentmap):
+        """ Returns the cache of the given map, creating it if needed. """
+        cache = cls._caches.get(currentmap)
+        if cache is None:
+            cache = cls(currentmap)
+            cls._caches[currentmap] = cache
+        return cache
+
+    def __init__(self, currentmap):
+        self.currentmap = currentmap
+        self.width = currentmap.width
+        self.height = currentmap.height
+        self.revision = None
+        self.passable = None
+        self.fields = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def has_field(self, target):
+        """ Returns True if the distance field towards the target tile is ready, so that a path to it is cheap. """
+        self.validate()
+        return (int(target[0]), int(target[1])) in self.fields
+
+    def validate(self):
+        """ Discards every field if the boxes of the map have changed since they were computed. """
+        if self.revision != self.currentmap.revision:
+            self.revision = self.currentmap.revision
+            self.passable = self.currentmap.passable_mask().ravel().tolist()
+            self.fields.clear()
+
+    def field(self, target):
+        """ Returns the distance field towards the target tile, as a flat list
+            indexed by x + y * width, with -1 for unreachable tiles.
+        """
+        self.validate()
+        key = (int(target[0]), int(target[1]))
+        field = self.fields.get(key)
+        if field is not None:
+            self.fields.move_to_end(key)
+            self.hits += 1
+            return field
+        self.misses += 1
+        field = self.compute_field(key)
+        self.keep(key, field)
+        return field
+
+    def add_field(self, target, field, revision):
+        """ Keeps a distance field computed elsewhere (by a worker of a
+            PlannerPool) on the boxes of the given map revision, unless the
+            boxes have changed since.
+        """
+        self.validate()
+        key = (int(target[0]), int(target[1]))
+        if revision == self.revision and key not in self.fields:
+            self.keep(key, field)
+
+    def keep(self, key, field):
+        """ Adds a field, forgetting the least recently used one if there are too many. """
+        self.fields[key] = field
+        if len(self.fields) > self.MAX_FIELDS:
+            self.fields.popitem(last=False)
+
+    def compute_field(self, target):
+        """ Breadth first search from the target over the passable tiles. """
+        width, height, passable = self.width, self.height, self.passable
+        distances = [-1] * (width * height)
+        tx, ty = target
+        if not (0 <= tx < width and 0 <= ty < height):
+            return distances
+        start = tx + ty * width
+        distances[start] = 0
+        queue = deque([start])
+        while queue:
+            index = queue.popleft()
+            distance = distances[index] + 1
+            x = index % width
+            for neighbour in (index + width if index + width < width * height else -1,
+                              index + 1 if x + 1 < width else -1,
+                              index - 1 if x > 0 else -1,
+                              index - width):
+                if neighbour >= 0 and distances[neighbour] < 0 and passable[neighbour]:
+                    distances[neighbour] = distance
+                    queue.append(neighbour)
+        return distances
+
+    def path(self, start, end, rng=None):
+        """ Returns the shortest path from start to end as a deque of tiles
+            (both included), or an empty deque if end can not be reached.
+            When several neighbours of a tile are one step closer to end, the
+            random.Random rng picks one, and without it the first one is taken.
+        """
+        width, height = self.width, self.height
+        distances = self.field(end)
+        x, y = int(start[0]), int(start[1])
+        if not (0 <= x < width and 0 <= y < height):
+            return deque()
+        distance = distances[x + y * width]
+        if distance < 0:
+            # The start tile itself may be blocked (for instance by a box the
+            # tank is pushing), so it can be left through any reachable neighbour
+            reachable = [distances[nx + ny * width] for nx, ny in ((x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1))
+                         if 0 <= nx < width and 0 <= ny < height and distances[nx + ny * width] >= 0]
+            if not reachable:
+                return deque()
+            distance = min(reachable) + 1
+        path = deque([Vec2d(x, y)])
+        while distance > 0:
+            # Step to any neighbour which is one step closer to the target
+            if rng is None:
+                for dx, dy in ((0, 1), (1, 0), (-1, 0), (0, -1)):
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < width and 0 <= ny < height and distances[nx + ny * width] == distance - 1:
+                        x, y = nx, ny
+                        break
+            else:
+                closer = [(nx, ny) for nx, ny in ((x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1))
+                          if 0 <= nx < width and 0 <= ny < height
+                          if distances[nx + ny * width] == distance - 1]
+                x, y = closer[0] if len(closer) == 1 else rng.choice(closer)
+            distance -= 1
+            path.append(Vec2d(x, y))
+        return path
+
+
+class IncrementalSearch:
+    """ Shortest paths from the tile of one Ai, kept from one search to the
+        next. This is Lifelong Planning A* without a heuristic: every tile
+        has a distance from the root (g) and the distance its neighbours say
+        it has (rhs), and only the tiles where the two differ are in the
+        queue. A search stops as soon as the goal is reached, so when the
+        goal moves (a flag carried by a tank) the search goes on from where it
+        stopped instead of starting again, and the path to a tile that was
+        already reached is read from the distances without searching at all.
+        When boxes of the map change, only the tiles that changed are queued
+        again and the distances that depend on them are repaired. The search
+        is only started again from the tile of the tank when the tank has left
+        the path to the goal.
+    """
+
+    def __init__(self, currentmap):
+        self.currentmap = currentmap
+        self.width = currentmap.width
+        self.height = currentmap.height
+        self.root = None
+        self.restarts = 0
+        self.expanded = 0
+
+    def restart(self, root):
+        """ Forgets every distance and starts a new search from the root tile. """
+        size = self.width * self.height
+        self.root = root
+        self.g = [math.inf] * size
+        self.rhs = [math.inf] * size
+        self.rhs[root] = 0
+        self.queue = [(0, root)]
+        self.queued = {root: 0}  # Tile -> key of its valid entry in the queue, the others are skipped
+        self.revision = self.currentmap.revision
+        self.mask = self.currentmap.passable_mask()
+        self.passable = self.mask.ravel().tolist()
+        self.restarts += 1
+
+    def neighbours(self, index):
+        width = self.width
+        x = index % width
+        if index + width < width * self.height:
+            yield index + width
+        if x + 1 < width:
+            yield index + 1
+        if x > 0:
+            yield index - 1
+        if index >= width:
+            yield index - width
+
+    def update_tile(self, index):
+        """ Computes the rhs of a tile from its neighbours and queues it if it differs from its distance. """
+        g, rhs = self.g, self.rhs
+        if index != self.root:
+            best = math.inf
+            if self.passable[index]:
+                for neighbour in self.neighbours(index):
+                    if g[neighbour] + 1 < best:
+                        best = g[neighbour] + 1
+            rhs[index] = best
+        if g[index] != rhs[index]:
+            key = min(g[index], rhs[index])
+            self.queued[index] = key
+            heapq.heappush(self.queue, (key, index))
+        else:
+            self.queued.pop(index, None)
+
+    def repair(self):
+        """ Queues the tiles whose boxes changed since the last search. """
+        if self.revision == self.currentmap.revision:
+            return
+        self.revision = self.currentmap.revision
+        mask = self.currentmap.passable_mask()
+        changed = numpy.flatnonzero(mask != self.mask).tolist()
+        self.mask = mask
+        self.passable = mask.ravel().tolist()
+        for index in changed:
+            self.update_tile(index)
+
+    def search(self, goal):
+        """ Expands the queued tiles until the distance of the goal is known. """
+        g, rhs, queue, queued = self.g, self.rhs, self.queue, self.queued
+        while queue:
+            key, index = queue[0]
+            if queued.get(index) != key:
+                heapq.heappop(queue)
+                continue
+            if key >= min(g[goal], rhs[goal]) and g[goal] == rhs[goal]:
+                break
+            heapq.heappop(queue)
+            del queued[index]
+            self.expanded += 1
+            if g[index] > rhs[index]:
+                g[index] = rhs[index]
+            else:
+                g[index] = math.inf
+                self.update_tile(index)
+            for neighbour in self.neighbours(index):
+                self.update_tile(neighbour)
+
+    def trace(self, goal):
+        """ Searches for the goal and returns the path from the root to it,
+            following decreasing distances. Like with the distance fields, the
+            goal tile itself may be blocked (for instance by a box pushed onto
+            the flag), it is then entered from its closest neighbour.
+        """
+        g, width = self.g, self.width
+        index = goal
+        if not self.passable[goal] and goal != self.root:
+            for neighbour in self.neighbours(goal):
+                if self.passable[neighbour]:
+                    self.search(neighbour)
+                    if g[neighbour] < g[index]:
+                        index = neighbour
+        else:
+            self.search(goal)
+        if g[index] == math.inf:
+            return deque()
+        path = deque([Vec2d(goal % width, goal // width)])
+        if index != goal:
+            path.appendleft(Vec2d(index % width, index // width))
+        while index != self.root:
+            index = next(neighbour for neighbour in self.neighbours(index) if g[neighbour] == g[index] - 1)
+            path.appendleft(Vec2d(index % width, index // width))
+        return path
+
+    def path(self, start, end):
+        """ Returns the shortest path from start to end as a deque of tiles
+            (both included), or an empty deque if end can not be reached.
+        """
+        width, height = self.width, self.height
+        x, y = int(start[0]), int(start[1])
+        ex, ey = int(end[0]), int(end[1])
+        if not (0 <= x < width and 0 <= y < height and 0 <= ex < width and 0 <= ey < height):
+            return deque()
+        root, goal = x + y * width, ex + ey * width
+        if self.root is None:
+            self.restart(root)
+        self.repair()
+        if self.root != root:
+            # A part of a shortest path is a shortest path, so the search can
+            # go on from where it started as long as the tank is on the path
+            path = self.trace(goal)
+            tile = Vec2d(x, y)
+            if tile in path:
+                while path[0] != tile:
+                    path.popleft()
+                return path
+            self.restart(root)
+        return self.trace(goal)
+
+
+class GridSnapshot:
+    """ A read-only copy of the boxes of a map at one revision, for the
+        workers of a PlannerPool to plan on while the match goes on. It has
+        what the planners use of a maps.Map.
+    """
+
+    def __init__(self, currentmap):
+        self.width = currentmap.width
+        self.height = currentmap.height
+        self.revision = currentmap.revision
+        self.boxes = currentmap.boxes.copy()
+        self.boxes.flags.writeable = False
+
+    def passable_mask(self):
+        return self.boxes == maps.GRASS
+
+
+def plan_path(snapshot, planner, start, end, costs, heuristic_weight):
+    """ Finds a path on a GridSnapshot like Ai.find_shortest_path, in a
+        worker of a PlannerPool. Returns the path and, for the "field"
+        planner, the distance field computed to find it, for the
+        DistanceFieldCache of the match to keep (None otherwise).
+    """
+    if planner == "astar":
+        path, _ = find_weighted_path(snapshot, start, end, costs, heuristic_weight)
+        return path, None
+    cache = DistanceFieldCache(snapshot)
+    return cache.path(start, end), cache.field(end)
+
+
+class PlannerPool:
+    """ Finds paths for the Ais in worker threads or processes, so that a
+        long search does not stall the game. An Ai given a pool sends its
+        path requests to it and keeps following its current path until the
+        new one arrives. Since that depends on how fast the workers are, a
+        match whose Ais use a pool is not reproducible from its seed.
+        kind is "thread", "process", or "auto" for processes on maps of
+        PROCESS_PLANNING_TILES tiles or more (threads share the interpreter
+        with the game, processes do not but copy the map for every request).
+    """
+
+    def __init__(self, kind="thread", workers=None, currentmap=None):
+        if kind == "auto":
+            large = currentmap is not None and currentmap.width * currentmap.height >= PROCESS_PLANNING_TILES
+            kind = "process" if large else "thread"
+        if kind not in ("thread", "process"):
+            raise ValueError('Unknown kind of planner pool "%s"' % kind)
+        self.kind = kind
+        self.executor = (ProcessPoolExecutor if kind == "process" else ThreadPoolExecutor)(max_workers=workers)
+        self.snapshots = weakref.WeakKeyDictionary()  # Map -> snapshot of its current revision
+        self.requests = 0
+
+    def snapshot(self, currentmap):
+        """ Returns a snapshot of the map, shared by every request made until its boxes change. """
+        snapshot = self.snapshots.get(currentmap)
+        if snapshot is None or snapshot.revision != currentmap.revision:
+            snapshot = GridSnapshot(currentmap)
+            self.snapshots[currentmap] = snapshot
+        return snapshot
+
+    def submit(self, bot, start, end):
+        """ Starts looking for a path for the Ai bot and returns the Future of the path. """
+        self.requests += 1
+        return self.executor.submit(plan_path, self.snapshot(bot.currentmap), bot.planner, start, end,
+                                    bot.tile_costs, bot.heuristic_weight)
+
+    def shutdown(self):
+        """ Stops the workers, without waiting for the requests in progress. """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LineOfSight:
+    """ What the Ais see in front of them, shared by every Ai playing on one map.
+        For every tile and heading (rounded to one of SIGHT_HEADINGS), the first
+        box or wall on a line of SHOOTING_RANGE tiles from the center of the
+        tile is found with a segment query of the space, ignoring tanks and
+        bullets, and kept until a box of the map is destroyed or moved.
+    """
+
+    MAX_ENTRIES = 100000
+
+    _caches = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_map(cls, currentmap, space):
+        """ Returns the cache of the given map, creating it if needed. """
+        cache = cls._caches.get(currentmap)
+        if cache is None:
+            cache = cls(currentmap, space)
+            cls._caches[currentmap] = cache
+        return cache
+
+    def __init__(self, currentmap, space):
+        self.currentmap = currentmap
+        self.space = space
+        self.revision = None
+        self.entries = {}
+        self.box_filter = pymunk.ShapeFilter(
+            mask=pymunk.ShapeFilter.ALL_MASKS() ^ (gameobjects.TANK_CATEGORY | gameobjects.BULLET_CATEGORY))
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def heading(angle):
+        """ Returns the index of the heading closest to the angle of a tank, and the direction of that heading. """
+        index = round(angle / (2 * math.pi) * SIGHT_HEADINGS) % SIGHT_HEADINGS
+        return index, Vec2d(0, 1).rotated(index * 2 * math.pi / SIGHT_HEADINGS)
+
+    def cached(self, tile, heading):
+        """ Returns the first box or wall seen from the tile towards the
+            heading, as (distance, box), if it is known. box is None for the
+            walls around the map and nothing in range.
+        """
+        if self.revision != self.currentmap.revision or len(self.entries) > self.MAX_ENTRIES:
+            self.revision = self.currentmap.revision
+            self.entries.clear()
+        entry = self.entries.get((tile, heading))
+        if entry is not None:
+            self.hits += 1
+        return entry
+
+    def look(self, tile, heading):
+        """ Finds the first box or wall seen from the tile towards the heading with a segment query. """
+        self.misses += 1
+        _, direction = self.heading(heading * 2 * math.pi / SIGHT_HEADINGS)
+        start = Vec2d(tile[0] + 0.5, tile[1] + 0.5)
+        info = self.space.segment_query_first(start, start + direction * SHOOTING_RANGE, 0, self.box_filter)
+        if info is None:
+            entry = (SHOOTING_RANGE, None)
+        else:
+            entry = ((info.point - start).length, getattr(info.shape, "parent", None))
+        self.entries[(tile, heading)] = entry
+        return entry
+
+
+def find_weighted_path(currentmap, start, end, costs=TILE_COSTS, heuristic_weight=1.0):
+    """ Weighted A* search from start to end, where entering a tile costs
+        costs[box type] (box types missing from costs can not be entered).
+        The heuristic is the Manhattan distance times heuristic_weight; with a
+        weight of 1 the path is optimal, larger weights expand fewer nodes.
+        Returns the path as a deque of tiles (both included) and the number of
+        expanded nodes.
+    """
+    width, height = currentmap.width, currentmap.height
+    cost_of_type = numpy.full(maps.BOX_TYPES, math.inf)
+    for box_type, cost in costs.items():
+        cost_of_type[box_type] = cost
+    tile_costs = cost_of_type[currentmap.boxes].ravel().tolist()
+    sx, sy = int(start[0]), int(start[1])
+    ex, ey = int(end[0]), int(end[1])
+    if not (0 <= sx < width and 0 <= sy < height and 0 <= ex < width and 0 <= ey < height):
+        return deque(), 0
+    start_index, end_index = sx + sy * width, ex + ey * width
+
+    g_scores = {start_index: 0}
+    came_from = {start_index: None}
+    closed = set()
+    # The frontier is a binary heap of (f score, g score, index) entries
+    frontier = [(heuristic_weight * (abs(ex - sx) + abs(ey - sy)), 0, start_index)]
+    expanded = 0
+    while frontier:
+        _, g_score, index = heapq.heappop(frontier)
+        if index in closed:
+            continue
+        if index == end_index:
+            break
+        closed.add(index)
+        expanded += 1
+        x, y = index % width, index // width
+        for nx, ny in ((x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1)):
+            if not (0 <= nx < width and 0 <= ny < height):
+                continue
+            neighbour = nx + ny * width
+            cost = tile_costs[neighbour]
+            if cost == math.inf or neighbour in closed:
+                continue
+            new_score = g_score + cost
+            if new_score < g_scores.get(neighbour, math.inf):
+                g_scores[neighbour] = new_score
+                came_from[neighbour] = index
+                f_score = new_score + heuristic_weight * (abs(ex - nx) + abs(ey - ny))
+                heapq.heappush(frontier, (f_score, new_score, neighbour))
+    else:
+        return deque(), expanded
+
+    path = deque()
+    index = end_index
+    while index is not None:
+        path.appendleft(Vec2d(index % width, index // width))
+        index = came_from[index]
+    return path, expanded
+
+
 class Ai:
     """ A simple ai that finds the shortest path to the target using
     a breadth first search. Also capable of shooting other tanks and or wooden
-    boxes. """
+    boxes, by calling shoot with its tank.
+    The planner is either "field" (shortest path over grass tiles, read from
+    the shared distance fields, or found with the IncrementalSearch of the Ai
+    while the flag it goes to is carried by another tank), "incremental"
+    (always the IncrementalSearch) or "astar" (weighted A* which may also go
+    through wood and metal boxes, see find_weighted_path).
+    An Ai makes at most queries_per_tick segment queries of the space per
+    tick on average to decide whether to shoot. With a planner_pool (see
+    PlannerPool) paths are searched for in the background. The random.Random
+    rng, usually the generator of the match, chooses between the shortest
+    paths read from the distance fields, so that matches vary with their seed.
+    start_angle is the angle the Ai turns its tank to on its first tick, if given. """
 
-    def __init__(self, tank, game_objects_list, tanks_list, space, currentmap):
+    def __init__(self, tank, game_objects, tanks_list, space, currentmap,
+                 planner="field", wood_cost=TILE_COSTS[maps.WOOD], metal_cost=TILE_COSTS[maps.METAL], heuristic_weight=1.0,
+                 shoot=None, queries_per_tick=0.5, planner_pool=None, rng=None, start_angle=None):
+        if planner not in ("field", "incremental", "astar"):
+            raise ValueError('Unknown planner "%s"' % planner)
         self.tank = tank
-        self.game_objects_list = game_objects_list
+        self.game_objects = game_objects
         self.tanks_list = tanks_list
         self.space = space
         self.currentmap = currentmap
         self.flag = None
-        self.max_x = currentmap.width - 1
-        self.max_y = currentmap.height - 1
 
+        self.planner = planner
+        self.tile_costs = {maps.GRASS: TILE_COSTS[maps.GRASS], maps.WOOD: wood_cost, maps.METAL: metal_cost}
+        self.heuristic_weight = heuristic_weight
+        self.path_cache = DistanceFieldCache.for_map(currentmap)
+        self.incremental_search = IncrementalSearch(currentmap)
+        self.planner_pool = planner_pool
+        self.rng = rng
+        self.start_angle = start_angle  # Angle the tank is turned to before it first moves
+        self.pending_path = None  # Future of the path being searched for by the planner pool
+        self.pending_field = None  # Target and map revision of that search
+        self.shoot = shoot
+        self.sight = LineOfSight.for_map(currentmap, space)
+        self.queries_per_tick = queries_per_tick
+        self.query_budget = QUERY_BURST
+        self.target_filter = pymunk.ShapeFilter(mask=pymunk.ShapeFilter.ALL_MASKS() ^ gameobjects.BULLET_CATEGORY)
         self.path = deque()
         self.update_grid_pos()
         self.next_coord = self.tank.body.position
@@ -52,15 +581,71 @@ class Ai:
         self.grid_pos = self.get_tile_of_position((self.tank.body.position.x, self.tank.body.position.y))
         
     def decide(self):
+        """ Replans if needed and steers the tank, all at once. In a match,
+            the AiScheduler does the same but spreads the replanning of the
+            Ais over several ticks.
+        """
+        if self.needs_replan():
+            self.replan()
+        self.act()
+
+    def needs_replan(self):
+        """ Returns True if the target moved since the path was found, or if
+            the tank is no longer next to its path (it was shot and respawned).
+        """
         if self.prev_flag_pos != self.get_target_tile():
-            self.update_grid_pos()
-            self.path = self.find_shortest_path(transpose(self.currentmap.boxes), self.grid_pos, self.get_target_tile())
-            try:
-                self.path.popleft()
-                self.next_coord = self.path.popleft() + Vec2d(0.5, 0.5)
-            except IndexError:
-                pass
-            self.prev_flag_pos = self.get_target_tile()
+            return True
+        return self.pending_path is None and \
+            (self.next_coord - self.tank.body.position).length > LOST_DISTANCE
+
+    def replan(self):
+        """ Finds a new path to the target, which is the expensive part of the Ai.
+            With a planner pool, the search is only started, unless the
+            path is cheap to find: read from a distance field that is already
+            computed, or repaired by the incremental search.
+        """
+        self.update_grid_pos()
+        target = self.get_target_tile()
+        self.prev_flag_pos = target
+        if self.planner_pool is not None and not self.path_is_cheap(target):
+            self.pending_path = self.planner_pool.submit(self, self.grid_pos, target)
+            self.pending_field = (target, self.currentmap.revision)
+            return
+        self.pending_path = None
+        self.follow(self.find_shortest_path(self.grid_pos, target))
+
+    def follow(self, path):
+        """ Starts following a new path. The tank may have moved since the
+            search started, so it goes on from its tile if the tile is on the
+            path, and from the start of the path otherwise.
+        """
+        self.path = path
+        tile = self.get_tile_of_position(self.tank.body.position)
+        if tile in path:
+            while path[0] != tile:
+                path.popleft()
+        try:
+            self.path.popleft()
+            self.next_coord = self.path.popleft() + Vec2d(0.5, 0.5)
+        except IndexError:
+            pass
+
+    def act(self):
+        """ Shoots if there is something to shoot at, and steers the tank along the current path. """
+        if self.start_angle is not None:
+            # Through a control method of the tank, so that replays record it
+            self.tank.align_angle(self.start_angle)
+            self.start_angle = None
+        if self.pending_path is not None and self.pending_path.done():
+            path, field = self.pending_path.result()
+            if field is not None:
+                # The other Ais going to the same target can use the field too
+                target, revision = self.pending_field
+                self.path_cache.add_field(target, field, revision)
+            self.follow(path)
+            self.pending_path = None
+        if self.shoot is not None and self.maybe_shoot():
+            self.shoot(self.tank)
         if self.next_coord.x + MIN_XY_DIF < self.tank.body.position[0]:
             self.choose_direction(math.pi/2)
         elif self.next_coord.x - MIN_XY_DIF > self.tank.body.position[0]:
@@ -71,11 +656,16 @@ class Ai:
             self.choose_direction(0)
         else:
             #self.tank.stop_moving()
-            self.tank.body.position = self.next_coord
+            self.tank.align_position(self.next_coord.x, self.next_coord.y)
             try:
                 self.next_coord = self.path.popleft() + Vec2d(0.5, 0.5)
             except IndexError:
-                pass
+                # The flag may be between tiles (in the middle of a generated map of even size),
+                # out of reach from the center of the last tile of the path
+                flag = self.get_flag()
+                if self.tank.flag is None and not flag.is_on_tank and \
+                        (Vec2d(flag.x, flag.y) - self.next_coord).length < 1:
+                    self.next_coord = Vec2d(flag.x, flag.y)
             
     def choose_direction(self, angle):
         if ((self.tank.body.angle) % (2 * math.pi) < (angle) % (2 * math.pi) - MIN_ANGLE_DIF and not (angle == 3*math.pi/2 and self.tank.body.angle == 0)) or (self.tank.body.angle) % (2 * math.pi) > (angle) % (2 * math.pi) - MIN_ANGLE_DIF + math.pi:
@@ -86,38 +676,68 @@ class Ai:
             self.tank.turn_left()
         else:
             self.tank.stop_turning()
-            self.tank.body.angle = angle
+            self.tank.align_angle(angle)
             self.tank.accelerate()
 
     def maybe_shoot(self):
         """ Makes a raycast query in front of the tank. If another tank
             or a wooden box is found, then we shoot.
+            The first box in front of the tank is read from the shared line
+            of sight cache. Only when it is not a wooden box is the space
+            queried again for tanks, up to that box. Every query made uses
+            one unit of the query budget of the Ai, and nothing is done when
+            the budget is empty.
         """
-        pass  # To be implemented
+        if not self.tank.ability_to_shoot():
+            return False
+        self.query_budget = min(self.query_budget + self.queries_per_tick, QUERY_BURST)
+        if self.query_budget < 1:
+            return False
+
+        position = self.tank.body.position
+        heading, direction = LineOfSight.heading(self.tank.body.angle)
+        tile = (int(position.x), int(position.y))
+        sight = self.sight.cached(tile, heading)
+        if sight is None:
+            self.query_budget -= 1
+            sight = self.sight.look(tile, heading)
+        distance, box = sight
+        if isinstance(box, gameobjects.Box) and box.destructable:
+            return True
+        if distance <= MUZZLE or self.query_budget < 1:
+            return False  # No tank fits before the box, or the budget is spent until a later tick
 
-    def find_shortest_path(self, grid, start, end):
-        """ A simple Breadth First Search using integer coordinates as our nodes.
-            Edges are calculated as we go, using an external function.
+        self.query_budget -= 1
+        start = position + direction * MUZZLE
+        info = self.space.segment_query_first(start, position + direction * distance, 0, self.target_filter)
+        return info is not None and isinstance(getattr(info.shape, "parent", None), gameobjects.Tank)
+
+    def uses_incremental_search(self):
+        """ Returns True if paths are found with the incremental search: always
+            with the "incremental" planner, and with the "field" planner while
+            the Ai chases the tank carrying the flag. The target then moves
+            almost every tile, so a distance field towards it would only be
+            used once.
         """
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-        queue = deque([(start, deque([start]))])  # Each element: (current_position, path)
-        visited = set()
-    
-        while queue:
-            (node, path) = queue.popleft()
-            x, y = node
-            if node == end:
-                return path
-    
-            if node in visited:
-                continue
-    
-            visited.add(node)
-    
-            for neighbour in self.get_tile_neighbors(node):
-                new_pos = Vec2d(neighbour.x, neighbour.y)
-                queue.append((new_pos, path + deque([new_pos])))
-        return deque()  # No valid path found
+        if self.planner == "field":
+            return self.tank.flag is None and self.get_flag().is_on_tank
+        return self.planner == "incremental"
+
+    def path_is_cheap(self, target):
+        """ Returns True if the path to target can be found without a long search. """
+        if self.planner == "astar":
+            return False
+        return self.uses_incremental_search() or self.path_cache.has_field(target)
+
+    def find_shortest_path(self, start, end):
+        """ Returns the shortest path from start to end, using the planner of this Ai. """
+        if self.planner == "astar":
+            path, _ = find_weighted_path(self.currentmap, start, end, self.tile_costs, self.heuristic_weight)
+            return path
+        if self.uses_incremental_search():
+            return self.incremental_search.path(start, end)
+        # The distance field towards end is shared by every Ai on the same map
+        return self.path_cache.path(start, end, self.rng)
 
     def get_target_tile(self):
         """ Returns position of the flag if we don't have it. If we do have the flag,
@@ -135,11 +755,7 @@ class Ai:
             where it is when the Ai object is initialized.
         """
         if self.flag is None:
-            # Find the flag in the game objects list
-            for obj in self.game_objects_list:
-                if isinstance(obj, gameobjects.Flag):
-                    self.flag = obj
-                    break
+            self.flag = self.game_objects.first(gameobjects.Flag)
         return self.flag
 
     def get_tile_of_position(self, position_vector):
@@ -147,22 +763,46 @@ class Ai:
         x, y = position_vector
         return Vec2d(int(x), int(y))
 
-    def get_tile_neighbors(self, coord_vec):
-        """ Returns all bordering grid squares of the input coordinate.
-            A bordering square is only considered accessible if it is grass
-            or a wooden box.
-        """
-        neighbors = []  # Find the coordinates of the tiles' four neighbors
-        neighbors.append(Vec2d(coord_vec[0],coord_vec[1]) + Vec2d(0,1))
-        neighbors.append(Vec2d(coord_vec[0],coord_vec[1]) + Vec2d(1,0))
-        neighbors.append(Vec2d(coord_vec[0],coord_vec[1]) + Vec2d(-1,0))
-        neighbors.append(Vec2d(coord_vec[0],coord_vec[1]) + Vec2d(0,-1))
-        return filter(self.filter_tile_neighbors, neighbors)
-
-    def filter_tile_neighbors(self, coord):
-        """ Used to filter the tile to check if it is a neighbor of the tank.
-        """
-        if 0 <= coord.x <= self.max_x and 0 <= coord.y <= self.max_y and self.currentmap.boxAt(coord.x, coord.y) == 0:
-            return True
-        return False
 
+class AiScheduler:
+    """ Runs the Ais of a match on every tick. Shooting and steering are
+        cheap and done by every Ai on every tick, but finding a new path is
+        not, so when many Ais need one at once (for instance when the flag is
+        captured) they wait in a queue and only some of them replan on each
+        tick: at most max_replans, and if time_budget is given, only while
+        less than time_budget seconds have been spent (but always at least
+        one). A time budget makes the match depend on the speed of the
+        computer, so it should not be used where matches must be
+        reproducible from their seed.
+        bots is the list of Ais of the match, whose Ais may be replaced.
+    """
+
+    def __init__(self, bots, max_replans=MAX_REPLANS_PER_TICK, time_budget=None):
+        self.bots = bots
+        self.max_replans = max_replans
+        self.time_budget = time_budget
+        self.queue = deque()  # Indexes in bots of the Ais waiting to replan, in order of arrival
+        self.queued = set()
+        self.replans = 0
+
+    def schedule(self):
+        """ Adds the Ais which need a new path to the queue. """
+        for i, bot in enumerate(self.bots):
+            if i not in self.queued and bot.needs_replan():
+                self.queue.append(i)
+                self.queued.add(i)
+
+    def replan(self):
+        """ Lets the Ais at the front of the queue replan, within the budget of the tick. """
+        start = time.perf_counter()
+        replans = 0
+        while self.queue and replans < self.max_replans:
+            if replans and self.time_budget is not None and time.perf_counter() - start >= self.time_budget:
+                break
+            i = self.queue.popleft()
+            self.queued.discard(i)
+            bot = self.bots[i]
+            if bot.needs_replan():  # The Ai may have been replaced since it was queued
+                bot.replan()
+                replans += 1
+        self.replans += replans
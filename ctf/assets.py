@@ -0,0 +1,140 @@
+""" Lazy loading of the images and sounds of the game.
+    An AssetManager loads a file of the data directory the first time it is
+    asked for and keeps it, so that importing the game needs neither a
+    display nor a mixer, and only the assets that are used are ever loaded.
+    Images are kept scaled for the current tile size (the files are drawn for
+    tiles of NATIVE_TILE_SIZE pixels), and converted for the display when
+    there is one.
+
+    With the null backend (see use_null_backend), which is meant for headless
+    simulations, no file is decoded: images are blank surfaces of the size of
+    the real ones, read from the header of the PNG file, since the physics
+    shapes of the objects are made from the size of their sprites, and
+    sounds are NullSounds.
+"""
+import os
+import struct
+import weakref
+
+import pygame
+
+main_dir = os.path.split(os.path.abspath(__file__))[0]
+
+NATIVE_TILE_SIZE = 40  # Size in pixels of a tile in the image files
+
+
+class NullSound:
+    """ Stands in for a pygame.mixer.Sound when the mixer is not initialised
+        (for instance in headless simulations). Every call is a no-op. """
+
+    def play(self, *args, **kwargs):
+        return None
+
+    def stop(self):
+        return None
+
+    def set_volume(self, value):
+        return None
+
+    def get_num_channels(self):
+        return 0
+
+
+def png_size(file):
+    """ Returns the (width, height) of a PNG image, read from its header without decoding it. """
+    with open(file, "rb") as f:
+        header = f.read(24)
+    if header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        raise SystemExit('Could not load image "%s" not a PNG file' % file)
+    return struct.unpack(">II", header[16:24])
+
+
+class AssetManager:
+    """ Loads the assets of a directory on first use and caches them. An
+        asset is identified by its file name and the variant asked for: the
+        size in native pixels and the rotation of an image, at the current
+        tile size. Every manager uses the null backend while
+        AssetManager.null is set.
+    """
+
+    null = False
+
+    _managers = weakref.WeakSet()
+
+    @classmethod
+    def use_null_backend(cls, null=True):
+        """ Makes every manager return placeholders (or real assets again), forgetting the assets already loaded. """
+        cls.null = null
+        for manager in cls._managers:
+            manager.clear()
+
+    def __init__(self, directory):
+        self.directory = os.path.join(main_dir, directory)
+        self.tile_size = NATIVE_TILE_SIZE
+        self.cache = {}
+        self.loads = 0
+        self._managers.add(self)
+
+    def clear(self):
+        self.cache.clear()
+
+    def set_tile_size(self, tile_size):
+        """ Scales the images returned from now on for tiles of tile_size pixels. """
+        if tile_size != self.tile_size:
+            self.tile_size = tile_size
+            self.clear()
+
+    def path(self, file):
+        return os.path.join(self.directory, file)
+
+    def image(self, file, size=None, angle=0):
+        """ Returns the image of file, scaled from size (in native pixels, the
+            size of the file by default) to the current tile size and rotated by angle degrees.
+        """
+        key = (file, size, angle)
+        image = self.cache.get(key)
+        if image is None:
+            image = self.cache[key] = self.load_image(file, size, angle)
+        return image
+
+    def load_image(self, file, size, angle):
+        self.loads += 1
+        path = self.path(file)
+        if self.null:
+            native = size or png_size(path)
+        else:
+            try:
+                image = pygame.image.load(path)
+            except (pygame.error, FileNotFoundError):
+                raise SystemExit('Could not load image "%s" %s' % (path, pygame.get_error()))
+            native = size or image.get_size()
+        scaled = (round(native[0] * self.tile_size / NATIVE_TILE_SIZE),
+                  round(native[1] * self.tile_size / NATIVE_TILE_SIZE))
+        if self.null:
+            # A blank surface is cheap, and can still be drawn and rotated like an image
+            image = pygame.Surface(scaled, pygame.SRCALPHA)
+        elif scaled != image.get_size():
+            image = pygame.transform.scale(image, scaled)
+        if angle:
+            image = pygame.transform.rotate(image, angle)
+        # Converting requires a display, which headless simulations do not have
+        if self.null or pygame.display.get_surface() is None:
+            return image
+        return image.convert_alpha()
+
+    def sound(self, file):
+        """ Returns the sound of file, or a NullSound when there is no mixer. """
+        sound = self.cache.get(file)
+        if sound is None:
+            sound = self.cache[file] = self.load_sound(file)
+        return sound
+
+    def load_sound(self, file):
+        self.loads += 1
+        if self.null or not pygame.mixer.get_init():
+            return NullSound()
+        path = self.path(file)
+        try:
+            return pygame.mixer.Sound(path)
+        except (pygame.error, FileNotFoundError):
+            raise SystemExit('Could not load sound "%s" %s' % (path, pygame.get_error()))
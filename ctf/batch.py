@@ -0,0 +1,106 @@
+""" Runs many headless matches in parallel, one match per worker process,
+    and collects their results in a single table.
+
+    Usage: python batch.py --maps map0 map1 --seeds 100 --workers 32 --output results.csv
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Keep the pygame banner of every worker out of the results written to stdout
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+# A job is a single match: the name of the map, the random seed and the
+# keyword arguments given to every Ai of the match.
+Job = namedtuple("Job", ["map_name", "seed", "ai_config"])
+
+COLUMNS = ["map", "seed", "ai_config", "ticks", "winner", "scores", "seconds"]
+
+
+def run_job(job, max_ticks, score_limit):
+    """ Runs a single job in the current process and returns its row of the results table. """
+    # Imported here so that the parent process never loads the framework
+    import assets
+    import engine
+    import maps
+
+    # Workers never draw or play anything
+    assets.AssetManager.use_null_backend()
+
+    result = engine.run_headless(maps.get_map(job.map_name), seed=job.seed, max_ticks=max_ticks,
+                                 score_limit=score_limit, ai_options=job.ai_config)
+    return {
+        "map": job.map_name,
+        "seed": job.seed,
+        "ai_config": json.dumps(job.ai_config or {}, sort_keys=True),
+        "ticks": result["ticks"],
+        "winner": result["winner"],
+        "scores": " ".join(str(score) for score in result["scores"]),
+        "seconds": round(result["seconds"], 4),
+    }
+
+
+def run_batch(jobs, workers=None, max_ticks=180000, score_limit=1, progress=None):
+    """ Runs every job in a pool of worker processes and returns the results
+        table, as a list of rows in the same order as the jobs.
+        progress is called with (done, total) every time a job finishes.
+    """
+    rows = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job, max_ticks, score_limit): i for i, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            rows[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(jobs))
+    return rows
+
+
+def load_jobs(file):
+    """ Reads jobs from a JSON file containing a list of [map, seed, ai_config] entries. """
+    with open(file) as f:
+        return [Job(map_name, seed, ai_config) for map_name, seed, ai_config in json.load(f)]
+
+
+def write_results(rows, file):
+    """ Writes the results table as CSV, to standard output if file is "-". """
+    out = sys.stdout if file == "-" else open(file, "w", newline="")
+    try:
+        writer = csv.DictWriter(out, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run headless matches in parallel")
+    parser.add_argument("--jobs", help="JSON file with a list of [map, seed, ai_config] jobs")
+    parser.add_argument("--maps", nargs="+", default=["map0"], help="maps to play when --jobs is not given")
+    parser.add_argument("--seeds", type=int, default=1, help="number of seeds per map when --jobs is not given")
+    parser.add_argument("--ai-config", default="{}", help="JSON object of ai options when --jobs is not given")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--max-ticks", type=int, default=180000, help="maximum length of a match")
+    parser.add_argument("--score-limit", type=int, default=1, help="score which ends a match")
+    parser.add_argument("--output", default="-", help="CSV file to write the results to")
+    args = parser.parse_args()
+
+    if args.jobs:
+        jobs = load_jobs(args.jobs)
+    else:
+        ai_config = json.loads(args.ai_config)
+        jobs = [Job(map_name, seed, ai_config) for map_name in args.maps for seed in range(args.seeds)]
+
+    def progress(done, total):
+        print(f"{done}/{total} matches", file=sys.stderr)
+
+    rows = run_batch(jobs, args.workers, args.max_ticks, args.score_limit, progress)
+    write_results(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+""" Benchmarks of the hot paths of the game, to compare how fast they are
+    from one change to the next:
+    - path: Ai.find_shortest_path on generated maps of increasing size,
+      with both planners, and every step of a chase after a moving target
+      with the field and incremental planners
+    - physics: space.step with increasing numbers of tanks, bullets and boxes
+    - world: space.step of matches on generated maps of increasing size,
+      with a normal world, a compact world and a compact world in a spatial hash
+    - render: update_screen of every object of a match on an offscreen surface
+
+    Every benchmark is run repeat times with the same seed and its median is
+    kept. The results are written as JSON, and compared with the results of a
+    previous run when one is given.
+
+    Usage: python bench.py --output bench.json --compare previous.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import numpy
+import pymunk
+
+GROUPS = ["path", "physics", "world", "render"]
+MAP_SIZES = [20, 50, 100, 200]
+PLANNERS = ["field", "astar"]
+CHASE_PLANNERS = ["field", "incremental"]
+OBJECT_COUNTS = [10, 50, 200, 800]
+PATH_QUERIES = 50
+CHASE_STEPS = 100
+PHYSICS_STEPS = 100
+WORLD_WARMUP = 50  # Ticks run before timing a world, long enough for the boxes at rest to sleep
+WORLDS = {
+    "normal": {},
+    "compact": {"compact_world": True},
+    "compact+hash": {"compact_world": True, "spatial_hash": True},
+}
+RENDER_FRAMES = 50
+
+
+def median_time(function, repeat):
+    """ Calls function repeat times and returns the median of its durations, in seconds. """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def result(group, name, params, seconds, count, unit):
+    """ Returns the row of a benchmark which did count operations in seconds. """
+    return {"group": group, "name": name, "params": params,
+            "value": seconds / count * 1e6, "unit": unit, "seconds": seconds}
+
+
+def bench_path(repeat, seed):
+    """ Times find_shortest_path from random grass tiles to the flag of generated maps. """
+    import engine
+    import mapgen
+
+    rows = []
+    for size in MAP_SIZES:
+        current_map = mapgen.generate_map(size, size, seed=seed, density=0.3)
+        rng = random.Random(seed)
+        grass = [tuple(tile) for tile in numpy.argwhere(current_map.passable_mask().T).tolist()]
+        starts = [rng.choice(grass) for _ in range(PATH_QUERIES)]
+        flag = tuple(int(coordinate) for coordinate in current_map.flag_position)
+        for planner in PLANNERS:
+            match = engine.Match(current_map, human_players=0, ai_options={"planner": planner}, seed=seed)
+            bot = match.ai_list[0]
+
+            def cold():
+                # Every query is made with an empty cache of distance fields
+                for start in starts:
+                    bot.path_cache.fields.clear()
+                    bot.find_shortest_path(start, flag)
+
+            def warm():
+                for start in starts:
+                    bot.find_shortest_path(start, flag)
+
+            params = {"size": size, "planner": planner}
+            rows.append(result("path", "find_shortest_path cold", params,
+                               median_time(cold, repeat), PATH_QUERIES, "us/path"))
+            rows.append(result("path", "find_shortest_path warm", params,
+                               median_time(warm, repeat), PATH_QUERIES, "us/path"))
+        rows += bench_chase(current_map, grass, flag, repeat, seed)
+    return rows
+
+
+def chase_walk(grass, start, rng):
+    """ Returns CHASE_STEPS tiles of a random walk over the grass tiles from start. """
+    grass = set(grass)
+    walk = [start]
+    for _ in range(CHASE_STEPS):
+        x, y = walk[-1]
+        walk.append(rng.choice([tile for tile in ((x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1))
+                                if tile in grass] or [(x, y)]))
+    return walk
+
+
+def bench_chase(current_map, grass, flag, repeat, seed):
+    """ Times finding a new path every step while chasing a target which walks
+        randomly from the flag, from the tile the previous path led to.
+    """
+    import ai
+    import engine
+
+    rng = random.Random(seed)
+    walk = chase_walk(grass, flag, rng)
+    first = rng.choice(grass)
+    rows = []
+    for planner in CHASE_PLANNERS:
+        match = engine.Match(current_map, human_players=0, ai_options={"planner": planner}, seed=seed)
+        bot = match.ai_list[0]
+
+        def chase():
+            bot.path_cache.fields.clear()
+            bot.incremental_search = ai.IncrementalSearch(current_map)
+            tile = first
+            for target in walk:
+                path = bot.find_shortest_path(tile, target)
+                if len(path) > 1:
+                    tile = tuple(path[1])
+
+        params = {"size": current_map.width, "planner": planner}
+        rows.append(result("path", "chase", params, median_time(chase, repeat), len(walk), "us/path"))
+    return rows
+
+
+def physics_scene(count, seed):
+    """ Returns a match on an empty map with count tanks driving in circles,
+        count bullets and count wood and metal boxes, all at random places.
+    """
+    import engine
+    import gameobjects
+    import images
+    import maps
+
+    size = max(10, int((count * 4) ** 0.5))
+    boxes = numpy.zeros((size, size), dtype=numpy.int8)
+    current_map = maps.Map(size, size, boxes, [[0.5, 0.5, 0]], [size / 2, size / 2])
+    match = engine.Match(current_map, human_players=1, seed=seed)
+    rng = random.Random(seed)
+    tiles = rng.sample([(x, y) for x in range(size) for y in range(size) if (x, y) != (0, 0)], 3 * count)
+    for i, (x, y) in enumerate(tiles[:count]):
+        tank = gameobjects.Tank(x + 0.5, y + 0.5, rng.uniform(0, 360), images.tanks[i % len(images.tanks)], match.space)
+        tank.shape.collision_type = gameobjects.collision_types["tank"]
+        tank.body.velocity = pymunk.Vec2d(0, gameobjects.Tank.NORMAL_MAX_SPEED).rotated(tank.body.angle)
+        tank.body.angular_velocity = 1 if i % 2 else -1
+        match.tanks_list.append(tank)
+    for i, (x, y) in enumerate(tiles[count:2 * count]):
+        box_type = maps.WOOD if i % 2 else maps.METAL
+        box = gameobjects.get_box_with_type(x, y, box_type, match.space)
+        box.shape.collision_type = box_type
+        match.game_objects.add(box)
+        match.boxes.add(box, x, y, box_type)
+    for x, y in tiles[2 * count:]:
+        # Bullets are fired by a tank which is not part of the match
+        shooter = gameobjects.Tank(x + 0.5, y + 0.5, rng.uniform(0, 360), images.tanks[0], pymunk.Space())
+        match.bullets.fire(shooter)
+    return match
+
+
+def bench_physics(repeat, seed):
+    """ Times space.step with count tanks, bullets and boxes. Bullets are
+        destroyed by what they hit, so a new scene is made for every repeat.
+    """
+    import engine
+
+    rows = []
+    for count in OBJECT_COUNTS:
+        durations = []
+        for _ in range(repeat):
+            match = physics_scene(count, seed)
+            start = time.perf_counter()
+            for _ in range(PHYSICS_STEPS):
+                match.space.step(1 / engine.FRAMERATE)
+            durations.append(time.perf_counter() - start)
+        rows.append(result("physics", "space.step", {"tanks": count, "bullets": count, "boxes": count},
+                           statistics.median(durations), PHYSICS_STEPS, "us/step"))
+    return rows
+
+
+def bench_world(repeat, seed):
+    """ Times space.step of matches on generated maps, once the ais have
+        started moving, with every kind of world of engine.Match.
+    """
+    import engine
+    import mapgen
+
+    rows = []
+    for size in MAP_SIZES:
+        current_map = mapgen.generate_map(size, size, seed=seed, density=0.3, players=6)
+        for name, options in WORLDS.items():
+            match = engine.Match(current_map, human_players=0, seed=seed, **options)
+            for _ in range(WORLD_WARMUP):
+                match.tick()
+
+            def step():
+                for _ in range(PHYSICS_STEPS):
+                    match.space.step(1 / engine.FRAMERATE)
+
+            rows.append(result("world", "space.step", {"size": size, "world": name},
+                               median_time(step, repeat), PHYSICS_STEPS, "us/step"))
+    return rows
+
+
+def bench_render(repeat, seed):
+    """ Times update_screen of every object of a match on an offscreen
+        surface, with tanks turning so that rotated sprites are looked up.
+    """
+    import pygame
+
+    import engine
+    import gameobjects
+    import images
+    import mapgen
+
+    rows = []
+    for size in MAP_SIZES[:3]:
+        current_map = mapgen.generate_map(size, size, seed=seed, density=0.3, players=6)
+        match = engine.Match(current_map, human_players=0, seed=seed)
+        surface = pygame.Surface((size * images.TILE_SIZE, size * images.TILE_SIZE))
+        objects = list(match.game_objects) + match.tanks_list
+
+        def draw():
+            for frame in range(RENDER_FRAMES):
+                for tank in match.tanks_list:
+                    tank.body.angle = frame * 0.1
+                for obj in objects:
+                    obj.update_screen(surface)
+
+        gameobjects.rotation_cache.clear()
+        seconds = median_time(draw, repeat)
+        rows.append(result("render", "update_screen", {"size": size, "objects": len(objects)},
+                           seconds, RENDER_FRAMES * len(objects), "us/object"))
+    return rows
+
+
+BENCHMARKS = {"path": bench_path, "physics": bench_physics, "world": bench_world, "render": bench_render}
+
+
+def git_revision():
+    """ Returns the commit the benchmarks were run on, or None outside of a git repository. """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(groups, repeat=5, seed=1):
+    """ Runs the benchmarks of the given groups and returns the results with a description of the machine. """
+    # The images are converted for a display like in the game, but nothing is ever shown
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    import pygame
+
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    rows = []
+    for group in groups:
+        rows += BENCHMARKS[group](repeat, seed)
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "pymunk": pymunk.version,
+        "machine": platform.platform(),
+        "repeat": repeat,
+        "seed": seed,
+        "results": rows,
+    }
+
+
+def key(row):
+    return row["group"], row["name"], json.dumps(row["params"], sort_keys=True)
+
+
+def print_results(report, previous=None):
+    """ Prints every result, with its ratio to the same benchmark of a previous report if given. """
+    before = {key(row): row["value"] for row in previous["results"]} if previous else {}
+    for row in report["results"]:
+        params = " ".join(f"{name}={value}" for name, value in row["params"].items())
+        line = f"{row['group']:8} {row['name']:26} {params:38} {row['value']:12.2f} {row['unit']}"
+        if key(row) in before:
+            line += f"  x{row['value'] / before[key(row)]:.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pathfinding, physics and rendering")
+    parser.add_argument("--groups", nargs="+", choices=GROUPS, default=GROUPS, help="benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs of every benchmark")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated maps and scenes")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", metavar="FILE", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    report = run(args.groups, args.repeat, args.seed)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(report, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
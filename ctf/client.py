@@ -0,0 +1,347 @@
+""" Window of a player of the multiplayer server (see server.py).
+    The client does not simulate the match. The remote tanks, bullets and
+    boxes are drawn a little in the past (INTERPOLATION_DELAY), between the
+    two snapshots around that time. The tank of the player is drawn where its
+    own inputs take it (see TankPrediction), so that it answers the keyboard
+    at once whatever the latency of the connection.
+
+    Usage: python client.py --host 127.0.0.1 --port 7777 --room default
+"""
+import argparse
+import asyncio
+import math
+from collections import deque
+
+import numpy
+
+import engine
+import gameobjects
+import net
+
+INTERPOLATION_DELAY = 4  # Ticks, the time between two snapshots of the server, twice
+SNAPSHOTS = 16  # Number of snapshots kept for interpolation
+PREDICTION_HISTORY = 2 * engine.FRAMERATE  # Ticks of predicted states kept to be compared with the snapshots
+# Prediction errors that are not corrected, a few quantization steps of the snapshots
+POSITION_TOLERANCE = 4 / net.POSITION_SCALE
+ANGLE_TOLERANCE = 4 * 2 * math.pi / net.ANGLE_STEPS
+ERROR_DECAY = 0.85  # Part of a corrected prediction error still drawn after each frame
+SNAP_DISTANCE = 1.0  # Errors of more than a tile (a tank sent back to its base) are not smoothed
+
+# Control methods of the tank of the player for the keys pressed and released
+KEYDOWN_INPUTS = {"K_UP": "accelerate", "K_DOWN": "decelerate", "K_LEFT": "turn_left", "K_RIGHT": "turn_right",
+                  "K_RETURN": "shoot"}
+KEYUP_INPUTS = {"K_UP": "stop_moving", "K_DOWN": "stop_moving", "K_LEFT": "stop_turning", "K_RIGHT": "stop_turning"}
+
+
+def blend(kind, previous, current, alpha):
+    """ Returns the rows of a dequantized state alpha of the way from previous
+        to current. Angles turn the shortest way, and objects which jumped
+        further than SNAP_DISTANCE are not interpolated. The other columns
+        (scores, flags) keep their previous values.
+    """
+    rows = previous.copy()
+    positions, angles = net.POSITION_COLUMNS[kind], net.ANGLE_COLUMNS[kind]
+    moves = current[:, positions] - previous[:, positions]
+    jumped = numpy.hypot(*moves.T) > SNAP_DISTANCE if len(positions) == 2 else numpy.zeros(len(rows), bool)
+    rows[:, positions] += moves * alpha
+    turns = (current[:, angles] - previous[:, angles] + math.pi) % (2 * math.pi) - math.pi
+    rows[:, angles] += turns * alpha
+    rows[jumped] = current[jumped]
+    return rows
+
+
+class SnapshotBuffer:
+    """ The last snapshots received from the server, and the state of the match between them. """
+
+    def __init__(self, size=SNAPSHOTS):
+        self.snapshots = deque(maxlen=size)  # (tick, dequantized state), oldest first
+        self.arrival = None  # Time at which the last snapshot arrived
+
+    def add(self, tick, state, now):
+        if self.snapshots and tick <= self.snapshots[-1][0]:
+            return
+        self.snapshots.append((tick, {kind: net.dequantize(kind, rows) for kind, rows in state.items()}))
+        self.arrival = now
+
+    def server_tick(self, now):
+        """ Estimates the tick the server is at from the last snapshot and the time since it arrived. """
+        return self.snapshots[-1][0] + (now - self.arrival) * engine.FRAMERATE
+
+    def sample(self, tick):
+        """ Returns the state of the match at tick (which may be between two
+            ticks), interpolated between the snapshots before and after it. Only
+            the bullets in both snapshots are moved between them. Before the
+            first snapshot and after the last, the closest one is returned.
+        """
+        snapshots = self.snapshots
+        if tick <= snapshots[0][0]:
+            return snapshots[0][1]
+        for (previous_tick, previous), (next_tick, current) in zip(snapshots, list(snapshots)[1:]):
+            if tick < next_tick:
+                break
+        else:
+            return snapshots[-1][1]
+        alpha = (tick - previous_tick) / (next_tick - previous_tick)
+        state = {kind: blend(kind, previous[kind], current[kind], alpha) for kind in ("tanks", "flag")}
+        if previous["boxes"].shape == current["boxes"].shape:
+            state["boxes"] = blend("boxes", previous["boxes"], current["boxes"], alpha)
+        else:
+            state["boxes"] = current["boxes"]
+        bullets = previous["bullets"]
+        later = current["bullets"]
+        _, mine, theirs = numpy.intersect1d(bullets[:, 0], later[:, 0], return_indices=True)
+        bullets = bullets.copy()
+        bullets[mine] = blend("bullets", bullets[mine], later[theirs], alpha)
+        state["bullets"] = bullets
+        return state
+
+
+class TankPrediction:
+    """ Predicts where the tank of the player is from the inputs it sent,
+        without waiting for the server. The motion of the tank is simulated
+        like Tank.update and a step of the space do, without collisions. The
+        server tells which inputs a snapshot includes and at which tick it
+        applied the last one, from which the tick of the prediction the
+        snapshot should match is known. When they differ, the prediction
+        starts again from the position of the server at that tick and the
+        inputs sent since are applied again. The correction is not drawn at
+        once but fades out over a few frames.
+    """
+
+    def __init__(self, tick, row):
+        self.tick = tick  # Number of ticks predicted
+        self.state = [row[0], row[1], row[2], 0.0, 0.0, 0.0, 0, 0]  # Position, angle, velocity, angular velocity, acceleration, rotation
+        self.max_speed = gameobjects.Tank.NORMAL_MAX_SPEED
+        self.pending = []  # Inputs sent since the last tick
+        self.inputs = {}  # Tick -> inputs applied at the start of that tick
+        self.history = {tick: list(self.state)}  # Tick -> state after that many ticks
+        self.applied = {}  # Number of an input -> tick it was applied at
+        self.error = [0.0, 0.0]  # Correction still drawn
+        self.corrections = 0
+
+    def input(self, number, name):
+        """ Applies an input sent to the server (with the number given by net.Client.send_input) from the next tick. """
+        self.pending.append((number, name))
+
+    @staticmethod
+    def apply(state, name):
+        """ Changes the state like the control method name of the tank does. """
+        if name == "accelerate":
+            state[6] = 1
+        elif name == "decelerate":
+            state[6] = -1
+        elif name == "stop_moving":
+            state[6] = 0
+            state[3] = state[4] = 0.0
+        elif name == "turn_left":
+            state[7] = -1
+        elif name == "turn_right":
+            state[7] = 1
+        elif name == "stop_turning":
+            state[7] = 0
+            state[5] = 0.0
+
+    def advance(self, state, tick):
+        """ Moves the state by the tick numbered tick. """
+        x, y, angle, vx, vy, angular_velocity, acceleration, rotation = state
+        if tick % engine.UPDATE_INTERVAL == 0:
+            thrust = gameobjects.Tank.ACCELERATION * acceleration
+            vx, vy = vx - thrust * math.sin(angle), vy + thrust * math.cos(angle)
+            speed = math.hypot(vx, vy)
+            if speed > self.max_speed:
+                vx, vy = vx * self.max_speed / speed, vy * self.max_speed / speed
+            angular_velocity += rotation * gameobjects.Tank.ACCELERATION
+            angular_velocity = max(-self.max_speed, min(angular_velocity, self.max_speed))
+        # Like a step of a space with engine.Match's damping: positions move, then velocities are damped
+        dt = 1 / engine.FRAMERATE
+        damping = 0.1 ** dt
+        state[:6] = (x + vx * dt, y + vy * dt, angle + angular_velocity * dt,
+                     vx * damping, vy * damping, angular_velocity * damping)
+
+    def step(self):
+        """ Predicts one more tick. """
+        inputs = [name for _, name in self.pending]
+        for number, name in self.pending:
+            self.applied[number] = self.tick
+            self.apply(self.state, name)
+        self.pending.clear()
+        self.inputs[self.tick] = inputs
+        self.advance(self.state, self.tick)
+        self.tick += 1
+        self.history[self.tick] = list(self.state)
+        old = self.tick - PREDICTION_HISTORY
+        self.history.pop(old, None)
+        self.inputs.pop(old, None)
+        self.error = [self.error[0] * ERROR_DECAY, self.error[1] * ERROR_DECAY]
+
+    def reconcile(self, tick, row, input_ack, input_tick, has_flag):
+        """ Compares the prediction with the state of the tank in the snapshot
+            of tick (a dequantized row), which includes the first input_ack
+            inputs, the last one applied at input_tick.
+        """
+        self.max_speed = gameobjects.Tank.FLAG_MAX_SPEED if has_flag else gameobjects.Tank.NORMAL_MAX_SPEED
+        if not self.applied and not self.pending:
+            # Nothing was predicted yet, the tank is where the server says
+            self.state[:3] = row[0], row[1], row[2]
+            self.history[self.tick] = list(self.state)
+            return
+        if input_ack not in self.applied:
+            return  # No input applied yet, or too long ago to know which tick the snapshot is
+        # The server has applied the earlier inputs, the next snapshots include them
+        for number in [number for number in self.applied if number < input_ack]:
+            del self.applied[number]
+        predicted_tick = tick - (input_tick - self.applied[input_ack])
+        state = self.history.get(predicted_tick)
+        if state is None or predicted_tick > self.tick:
+            return
+        turn = (row[2] - state[2] + math.pi) % (2 * math.pi) - math.pi
+        if math.hypot(row[0] - state[0], row[1] - state[1]) <= POSITION_TOLERANCE and abs(turn) <= ANGLE_TOLERANCE:
+            return
+        self.corrections += 1
+        shown = self.position()
+        state = list(state)
+        state[:3] = row[0], row[1], state[2] + turn
+        self.history[predicted_tick] = list(state)
+        for replayed in range(predicted_tick, self.tick):
+            for name in self.inputs.get(replayed, ()):
+                self.apply(state, name)
+            self.advance(state, replayed)
+            self.history[replayed + 1] = list(state)
+        self.state = state
+        error = (shown[0] - state[0], shown[1] - state[1])
+        self.error = list(error) if math.hypot(*error) < SNAP_DISTANCE else [0.0, 0.0]
+
+    def position(self):
+        """ Returns where the tank is drawn: the predicted position plus what is left of the last correction. """
+        return self.state[0] + self.error[0], self.state[1] + self.error[1], self.state[2]
+
+
+class RemoteMatch:
+    """ A Match made from the map sent by the server which is never
+        simulated: its objects are only put where the snapshots say, so that
+        the Renderer can draw it like a local match.
+    """
+
+    def __init__(self, current_map):
+        # Every tank is a human player, so that there is no ai
+        self.match = engine.Match(current_map, human_players=len(current_map.start_positions))
+        self.boxes = self.match.movable_boxes()
+        self.bullets = {}  # Id of a bullet of the server -> bullet of the match
+
+    def show(self, state, player=-1, prediction=None):
+        """ Puts every object where state says, and the tank of the player where it is predicted to be. """
+        match = self.match
+        for i, (tank, row) in enumerate(zip(match.tanks_list, state["tanks"].tolist())):
+            x, y, angle, tank.score, has_flag = row
+            if i == player and prediction is not None:
+                x, y, angle = prediction.position()
+            tank.body.position = x, y
+            tank.body.angle = angle
+            tank.flag = match.flag if has_flag else None
+
+        for box, (alive, x, y, angle) in zip(self.boxes, state["boxes"].tolist()):
+            if box not in match.boxes:
+                continue
+            if not alive:
+                match.space.remove(box.shape, box.body)
+                match.game_objects.remove(box)
+                match.moving_boxes.pop(box, None)
+                match.boxes.remove(box)
+            elif box.body.position != (x, y) or box.body.angle != angle:
+                box.body.position = x, y
+                box.body.angle = angle
+                match.moving_boxes[box] = True
+
+        rows = {int(row[0]): row for row in state["bullets"].tolist()}
+        for serial in [serial for serial in self.bullets if serial not in rows]:
+            match.bullets.release(self.bullets.pop(serial))
+        for serial, (_, x, y, angle) in rows.items():
+            bullet = self.bullets.get(serial)
+            if bullet is None:
+                bullet = self.bullets[serial] = match.bullets.fire(match.tanks_list[0])
+            bullet.body.position = x, y
+            bullet.body.angle = angle
+
+        flag = match.flag
+        (x, y, on_tank), = state["flag"].tolist()
+        flag.is_on_tank = bool(on_tank)
+        carrier = next((tank for tank in match.tanks_list if tank.flag is flag), None)
+        if carrier is not None:
+            carrier.post_update()  # Puts the flag on the tank, where it is drawn
+        else:
+            flag.x, flag.y = x, y
+
+
+async def play(args):
+    """ Joins a room of the server and shows it in a window until it is closed. """
+    import pygame
+
+    pygame.init()
+    pygame.display.set_mode()
+    # The framework needs to be imported after initialisation of pygame
+    import images
+    from ctf import create_background
+    from renderer import Renderer
+
+    client = net.Client()
+    await client.connect(args.host, args.port, args.room)
+    remote = RemoteMatch(client.current_map)
+    screen = pygame.display.set_mode(client.current_map.rect().size)
+    renderer = Renderer(screen, remote.match, create_background(screen, client.current_map, images))
+    loop = asyncio.get_running_loop()
+    buffer = SnapshotBuffer()
+    prediction = None
+
+    async def receive():
+        nonlocal prediction
+        while True:
+            tick, state = await client.receive()
+            buffer.add(tick, state, loop.time())
+            if client.tank >= 0:
+                row = buffer.snapshots[-1][1]["tanks"][client.tank]
+                if prediction is None:
+                    prediction = TankPrediction(tick, row)
+                prediction.reconcile(tick, row, client.input_ack, client.input_tick, bool(row[4]))
+
+    receiver = asyncio.create_task(receive())
+    keydown = {getattr(pygame, key): name for key, name in KEYDOWN_INPUTS.items()}
+    keyup = {getattr(pygame, key): name for key, name in KEYUP_INPUTS.items()}
+    running = True
+    try:
+        while running and not receiver.done():
+            frame_start = loop.time()
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                    running = False
+                inputs = keydown if event.type == pygame.KEYDOWN else keyup if event.type == pygame.KEYUP else {}
+                name = inputs.get(getattr(event, "key", None))
+                if name is not None and client.tank >= 0:
+                    number = client.send_input(name)
+                    if prediction is not None:
+                        prediction.input(number, name)
+
+            if buffer.snapshots:
+                server_tick = buffer.server_tick(loop.time())
+                if prediction is not None:
+                    while prediction.tick < server_tick:
+                        prediction.step()
+                remote.show(buffer.sample(server_tick - INTERPOLATION_DELAY), client.tank, prediction)
+                renderer.draw()
+            await asyncio.sleep(max(0.0, 1 / args.fps - (loop.time() - frame_start)))
+    finally:
+        receiver.cancel()
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play on a capture the flag server")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the server")
+    parser.add_argument("--port", type=int, default=7777, help="port of the server")
+    parser.add_argument("--room", default="default", help="name of the room to join")
+    parser.add_argument("--fps", type=int, default=60, help="maximum number of frames displayed per second")
+    args = parser.parse_args()
+    asyncio.run(play(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,505 @@
+""" The simulation part of the game: a Match owns the physics space and every
+    game object of one game, and advances them one tick at a time.
+    It does not touch the display, so it is used both by ctf.py and for
+    headless simulations.
+"""
+import hashlib
+import math
+import random
+import struct
+import time
+
+import numpy
+import pymunk
+
+import ai
+import gameobjects
+import images
+import maps
+import profiler as profiling
+import sounds
+
+FRAMERATE = 50  # Number of ticks per second of game time
+UPDATE_INTERVAL = 3  # update() is only called on every third tick
+MAX_TICKS_PER_FRAME = 5  # When the display lags further behind, game time is slowed down instead
+START_JITTER = 5  # The ais turn their tank by up to this many degrees at the start, drawn from the seed of the match
+
+# In a compact world (see Match), bodies which moved slower than SLEEP_SPEED tiles per second
+# for SLEEP_TIME seconds are put to sleep
+SLEEP_SPEED = 1e-3
+SLEEP_TIME = 0.5
+# Spatial hash of a space: cells of two tiles (2 * images.TILE_SIZE pixels, a tile is one unit
+# of the physics) and HASH_BUCKETS_PER_TILE buckets per tile of the map, the fastest on generated maps
+HASH_CELL_SIZE = 2.0
+HASH_BUCKETS_PER_TILE = 1
+
+
+def remove_shape(space, shape, shape2=None):
+    """Removes shapes and bodies from the space"""
+    space.remove(shape, shape.body)
+    if shape2:
+        space.remove(shape2, shape2.body)
+
+
+def reset_tank(tank):
+    """Reset the tanks position to its starting position."""
+    tank.body.position = tank.start_position.x, tank.start_position.y
+    tank.body.angle = tank.start_orientation
+
+
+def barrier(current_map, space):
+    """Adds a barrier to prevent from going outside the screen"""
+    static_body = space.static_body
+    static_lines = [
+        pymunk.Segment(static_body, (0, 0), (current_map.width, 0), 0.0),
+        pymunk.Segment(static_body, (current_map.width, 0), (current_map.width, current_map.height), 0.0),
+        pymunk.Segment(static_body, (0, 0), (0, current_map.height), 0.0),
+        pymunk.Segment(static_body, (0, current_map.height), (current_map.width, current_map.height), 0.0),
+    ]
+    for line in static_lines:
+        line.elasticity = 1
+        line.friction = 0.9
+    space.add(*static_lines)
+
+
+def rock_rectangles(boxes):
+    """ Covers the rock tiles of a grid of box types with few rectangles, by
+        greedy meshing: the first rock tile not covered yet (row by row) is
+        grown to the right as far as possible, then down as far as the whole
+        row below is rock. Returns a list of (x, y, width, height) in tiles.
+    """
+    rock = boxes == maps.ROCK
+    covered = numpy.zeros(rock.shape, dtype=bool)
+    height, width = rock.shape
+    rectangles = []
+    for y, x in numpy.argwhere(rock).tolist():
+        if covered[y, x]:
+            continue
+        right = x + 1
+        while right < width and rock[y, right] and not covered[y, right]:
+            right += 1
+        bottom = y + 1
+        while bottom < height and rock[bottom, x:right].all() and not covered[bottom, x:right].any():
+            bottom += 1
+        covered[y:bottom, x:right] = True
+        rectangles.append((x, y, right - x, bottom - y))
+    return rectangles
+
+
+def merge_rocks(current_map, space):
+    """ Adds the rock boxes of the map to the space as one static shape per
+        rectangle of rock_rectangles, rather than one body and shape per box.
+        Rocks never move nor break, so only the number of shapes changes.
+    """
+    shapes = []
+    for x, y, width, height in rock_rectangles(current_map.boxes):
+        shape = pymunk.Poly(space.static_body, [(x, y), (x, y + height), (x + width, y + height), (x + width, y)])
+        shape.collision_type = maps.ROCK
+        shapes.append(shape)
+    space.add(*shapes)
+    return shapes
+
+
+class Match:
+    """ A single game on one map. Tanks with an index lower than human_players
+        are controlled from the outside (the keyboard in ctf.py), all the
+        others are controlled by an Ai, created with the keyword arguments in
+        ai_options.
+        A tick always simulates 1 / FRAMERATE seconds, split in substeps steps
+        of the physics engine, so a match only depends on its map, seed and
+        inputs and never on how fast it is displayed. When interpolate is set,
+        the screen position of every moving object is saved before each tick
+        (see previous_states) so that it can be drawn between two ticks.
+        Every phase of a tick is timed by the given profiler.Profiler, if any.
+        The ais look for new paths within the budget of the ai.AiScheduler:
+        a few of them per tick, and if ai_time_budget is given, for at most
+        that many seconds per tick. With a planner_pool (an ai.PlannerPool)
+        the searches are made in the background.
+        A compact world is faster to simulate on large maps, but the matches
+        differ from those of a normal world: adjacent rock boxes share static
+        shapes (see merge_rocks) and boxes at rest sleep until something
+        touches them. With spatial_hash, the shapes are indexed in a spatial
+        hash rather than the default tree, which was slower on every
+        generated map measured (see the world benchmark of bench.py).
+    """
+
+    def __init__(self, current_map, human_players=1, ai_options=None, seed=None, substeps=1, interpolate=False,
+                 profiler=None, ai_time_budget=None, planner_pool=None, compact_world=False, spatial_hash=False):
+        # The boxes of the map change during the match, so the match has its own copy
+        self.current_map = current_map.copy()
+        self.human_players = human_players
+        self.planner_pool = planner_pool
+        self.ai_options = ai_options or {}
+        if seed is None:
+            seed = random.randrange(1 << 63)  # Kept, so that replays of the match can use it
+        self.seed = seed
+        self.random = random.Random(seed)  # Every random decision of the match must use this generator
+        self.substeps = substeps
+        self.compact_world = compact_world
+        self.spatial_hash = spatial_hash
+        self.interpolate = interpolate
+        self.previous_states = {}
+        self.tick_listeners = []  # Called without arguments at the end of every tick
+        self.profiler = profiler or profiling.NULL_PROFILER
+
+        # -- Initialise the physics
+        self.space = pymunk.Space()
+        self.space.gravity = (0.0, 0.0)
+        self.space.damping = 0.1  # Adds friction to the ground for all objects
+        if spatial_hash:
+            self.space.use_spatial_hash(HASH_CELL_SIZE, HASH_BUCKETS_PER_TILE * current_map.width * current_map.height)
+        if compact_world:
+            # Tanks and bullets never sleep: their velocity is set on every update, which wakes them
+            self.space.idle_speed_threshold = SLEEP_SPEED
+            self.space.sleep_time_threshold = SLEEP_TIME
+
+        # -- List of all game objects
+        self.game_objects = gameobjects.EntityRegistry()  # Boxes, bases and flag
+        self.tanks_list = []
+        # Flying bullets, in the list of the pool which removes them from the space
+        self.bullets = gameobjects.BulletPool(self.space)
+        self.bullet_list = self.bullets.live
+        self.ai_list = []
+        self.boxes = maps.TileIndex(self.current_map)  # Tile of every box, which keeps the boxes of the map up to date
+        # Wood and metal boxes which were touched and may not be at rest yet. It
+        # is a dictionary rather than a set so that it is visited in a
+        # reproducible order.
+        self.moving_boxes = {}
+
+        self.ticks = 0
+
+        self.add_collision_handlers()
+        self.flag = self.create_flag()
+        barrier(self.current_map, self.space)
+        self.create_boxes()
+        self.create_tanks()
+        self.ai_scheduler = ai.AiScheduler(self.ai_list, time_budget=ai_time_budget)
+
+    def add_collision_handlers(self):
+        """ Creates the CollisionHandlers between bullets and the other collision types. """
+        def add(object1, object2, collision_function, name):
+            handle = self.space.add_collision_handler(object1, object2)
+            handle.pre_solve = self.profiler.counted(name, collision_function)
+            return handle
+
+        bullet = gameobjects.collision_types["bullet"]
+        add(bullet, gameobjects.collision_types["wood"], self.collision_bullet_wood, "bullet-wood")
+        add(bullet, gameobjects.collision_types["wall"], self.collision_bullet_wall, "bullet-wall")
+        add(bullet, gameobjects.collision_types["metal"], self.collision_bullet_wall, "bullet-metal")
+        add(bullet, 0, self.collision_bullet_wall, "bullet-barrier")
+        add(bullet, gameobjects.collision_types["tank"], self.collision_bullet_tank, "bullet-tank")
+
+        # Boxes only move when something touches them, or when a box they touched was pushed away
+        # from them or destroyed (this contact may have pushed them without a new collision)
+        for box_type, name in ((gameobjects.collision_types["wood"], "wood-any"),
+                               (gameobjects.collision_types["metal"], "metal-any")):
+            handler = self.space.add_wildcard_collision_handler(box_type)
+            handler.begin = self.profiler.counted(name, self.collision_box)
+            handler.separate = self.profiler.counted(name + "-separate", self.collision_box)
+
+    def collision_box(self, arb, space, data):
+        """Triggered when something touches a wood or metal box, or stops touching it, which may start moving."""
+        for shape in arb.shapes:
+            box = getattr(shape, "parent", None)  # The barrier has no parent
+            if box in self.boxes and box.body.body_type == pymunk.Body.DYNAMIC:
+                self.moving_boxes[box] = True
+        return True
+
+    def collision_bullet_wood(self, arb, space, data):
+        """Triggered when bullet and wooden box collide, removing both from the space and their lists."""
+        if not self.bullets.release(arb.shapes[0].parent):
+            return False  # The bullet already hit something else during this step
+        sounds.mixer.play("explosion_sound")
+        box = arb.shapes[1].parent
+        if box not in self.boxes:
+            return True  # Another bullet destroyed the box during this step
+        remove_shape(space, arb.shapes[1])
+        self.game_objects.remove(box)
+        self.moving_boxes.pop(box, None)
+        self.boxes.remove(box)
+        return True
+
+    def collision_bullet_wall(self, arb, space, data):
+        """Triggered when bullet and wall collide, removing the bullet from the space and bullet_list."""
+        if not self.bullets.release(arb.shapes[0].parent):
+            return False
+        sounds.mixer.play("explosion_sound")
+        return True
+
+    def collision_bullet_tank(self, arb, space, data):
+        """Triggered when bullet and tank collide, removing the bullet from the space and bullet_list and resetting the position of the tank."""
+        if not self.bullets.release(arb.shapes[0].parent):
+            return False
+        sounds.mixer.play("explosion_sound")
+        reset_tank(arb.shapes[1].parent)
+        return True
+
+    def create_boxes(self):
+        """Adds boxes to the map that acts as physical objects"""
+        if self.compact_world:
+            # The rock boxes are still game objects, to be drawn, but not in the space
+            merge_rocks(self.current_map, self.space)
+        # Visit the tiles which are not grass, column by column
+        for x, y in numpy.argwhere(self.current_map.boxes.T != maps.GRASS).tolist():
+            box_type = self.current_map.boxAt(x, y)
+            space = None if self.compact_world and box_type == maps.ROCK else self.space
+            box = gameobjects.get_box_with_type(x, y, box_type, space)
+            box.shape.collision_type = box_type
+            self.game_objects.add(box)
+            self.boxes.add(box, x, y, box_type)
+
+    def movable_boxes(self):
+        """ Returns the wood and metal boxes which were not destroyed, in the order they were created. """
+        return [box for box in self.boxes if box.body.body_type == pymunk.Body.DYNAMIC]
+
+    def update_box_tiles(self):
+        """ Moves the boxes of the map along with the wood and metal boxes that were pushed to another tile.
+            Only the boxes that were touched are checked, and they are forgotten once they are at rest.
+        """
+        max_x = self.current_map.width - 1
+        max_y = self.current_map.height - 1
+        pending = list(self.moving_boxes)
+        while pending:
+            box = pending.pop()
+            position = box.body.position
+            self.boxes.move(box, min(max(int(position.x), 0), max_x), min(max(int(position.y), 0), max_y))
+            if box.body.velocity.get_length_sqrd() >= 1e-6 or abs(box.body.angular_velocity) >= 1e-3 \
+                    or any(isinstance(other, gameobjects.Tank) for other in self.touching(box)):
+                # It may push the boxes it touches, or a tank may push it into them
+                pending += self.track_touching(box)
+            else:
+                del self.moving_boxes[box]
+
+    def touching(self, box):
+        """ Returns the game objects in contact with the box (a tank may push it again without a new collision). """
+        touching = []
+        box.body.each_arbiter(lambda arb: touching.extend(getattr(shape, "parent", None) for shape in arb.shapes
+                                                          if shape.body is not box.body))
+        return touching
+
+    def track_touching(self, box):
+        """ Adds the wood and metal boxes in contact with the box to moving_boxes and returns those
+            which were not there yet. A box pushes the boxes it was already touching without a new
+            collision, so they would not be tracked otherwise.
+        """
+        tracked = []
+        for other in self.touching(box):
+            if other not in self.moving_boxes and other in self.boxes and other.body.body_type == pymunk.Body.DYNAMIC:
+                self.moving_boxes[other] = True
+                tracked.append(other)
+        return tracked
+
+    def create_tanks(self):
+        """Creates a tank and a base on every starting position, and an ai for the tanks not controlled by a player."""
+        for i, pos in enumerate(self.current_map.start_positions):
+            tank = gameobjects.Tank(pos[0], pos[1], pos[2], images.tanks[i], self.space)
+            tank.shape.collision_type = gameobjects.collision_types["tank"]
+            self.tanks_list.append(tank)
+            base = gameobjects.GameVisibleObject(pos[0], pos[1], images.bases[i])
+            self.game_objects.add(base)
+            if i >= self.human_players:
+                start_angle = tank.body.angle + math.radians(self.random.uniform(-START_JITTER, START_JITTER))
+                self.ai_list.append(self.create_ai(tank, start_angle))
+
+    def create_ai(self, tank, start_angle=None):
+        """ Creates the Ai controlling the given tank, which it turns to start_angle first if given. """
+        return ai.Ai(tank, self.game_objects, self.tanks_list, self.space, self.current_map, shoot=self.shoot,
+                     planner_pool=self.planner_pool, rng=self.random, start_angle=start_angle, **self.ai_options)
+
+    def create_flag(self):
+        """Creates the flag on its starting position."""
+        flag = gameobjects.Flag(self.current_map.flag_position[0], self.current_map.flag_position[1])
+        self.game_objects.add(flag)
+        return flag
+
+    def shoot(self, tank):
+        """ Makes the tank shoot if it is able to. """
+        bullet = tank.shoot(self.bullets)
+        if bullet is not None:
+            # The bullet may be reused, it must not be drawn between its old and new position
+            self.previous_states.pop(bullet, None)
+
+    def scores(self):
+        """ Returns the score of every tank. """
+        return [tank.score for tank in self.tanks_list]
+
+    def save_previous_states(self):
+        """ Saves the screen position and orientation of every object that may move during the next tick. """
+        states = {}
+        for obj in self.tanks_list + self.bullet_list + list(self.moving_boxes) + [self.flag]:
+            states[obj] = (obj.screen_position(), obj.screen_orientation())
+        self.previous_states = states
+
+    def tick(self):
+        """ Advances the match by one tick (1 / FRAMERATE seconds of game time).
+            Returns the list of tanks that brought the flag home during this tick.
+        """
+        profiler = self.profiler
+        tick_start = start = profiler.clock()
+        if self.interpolate:
+            self.save_previous_states()
+
+        # -- Update physics
+        if self.ticks % UPDATE_INTERVAL == 0:
+            # Loop over all the game objects and update their speed in function of their
+            # acceleration.
+            for obj in self.game_objects:
+                obj.update()
+            # Tanks and bullets are updated all at once, with numpy
+            gameobjects.update_tanks(self.tanks_list)
+            gameobjects.update_bullets(self.bullet_list)
+            start = profiler.lap("tick.update", start)
+
+        #   Check collisions and update the objects position
+        for _ in range(self.substeps):
+            self.space.step(1 / FRAMERATE / self.substeps)
+        self.bullets.update()
+        start = profiler.lap("tick.step", start)
+        # Boxes are slow, checking whether they changed tile at the same rate as update() is enough
+        if self.ticks % UPDATE_INTERVAL == UPDATE_INTERVAL - 1:
+            self.update_box_tiles()
+            start = profiler.lap("tick.box_tiles", start)
+
+        #   Update object that depends on an other object position (for instance a flag)
+        for obj in self.game_objects:
+            obj.post_update()
+        start = profiler.lap("tick.post_update", start)
+
+        # Try to grab the flag and then if it has the flag update the posistion of the tank
+        winners = []
+        for tank in self.tanks_list:
+            tank.try_grab_flag(self.flag)
+            tank.post_update()
+            if tank.has_won():
+                sounds.mixer.play("win_sound")
+                self.game_objects.remove(tank.flag)
+                self.flag = self.create_flag()
+                reset_tank(tank)
+                tank.flag = None
+                tank.score += 1
+                winners.append(tank)
+                # The ais keep a reference to the old flag, so they are recreated
+                for i in range(self.human_players, len(self.tanks_list)):
+                    self.ai_list[i - self.human_players] = self.create_ai(self.tanks_list[i])
+        start = profiler.lap("tick.flag", start)
+
+        # The decisions of the ais take effect during the next tick, which
+        # matters for replays where they are recorded along with the keyboard inputs
+        self.ticks += 1
+
+        # Update ai
+        # Every ai steers, but only some of those which need a new path get it during this tick
+        ai_start = start
+        self.ai_scheduler.schedule()
+        self.ai_scheduler.replan()
+        start = profiler.lap("tick.ai_replan", start)
+        for i, bot in enumerate(self.ai_list, self.human_players):
+            bot.act()
+            start = profiler.lap_ai(i, start)
+        profiler.lap("tick.ai", ai_start)
+
+        # The sounds asked for during the tick are played together
+        sounds.mixer.flush()
+        start = profiler.lap("tick.sound", start)
+
+        for listener in self.tick_listeners:
+            listener()
+        if profiler.enabled:
+            profiler.lap("tick", tick_start)
+            self.count_objects()
+        return winners
+
+    def count_objects(self):
+        """ Gives the number of objects of every kind to the profiler. """
+        self.profiler.gauge("objects", len(self.game_objects))
+        self.profiler.gauge("tanks", len(self.tanks_list))
+        self.profiler.gauge("bullets", len(self.bullet_list))
+        self.profiler.gauge("moving_boxes", len(self.moving_boxes))
+        self.profiler.gauge("bodies", len(self.space.bodies))
+
+    def state_hash(self):
+        """ Returns a digest of the exact state of every moving body and of the
+            scores, to check that two simulations are identical bit for bit.
+        """
+        digest = hashlib.sha256(struct.pack("<q", self.ticks))
+        for obj in self.tanks_list + self.bullet_list + self.movable_boxes():
+            body = obj.body
+            digest.update(struct.pack("<7d", body.position.x, body.position.y, body.angle,
+                                      body.velocity.x, body.velocity.y, body.angular_velocity, obj.shape.collision_type))
+        digest.update(struct.pack("<2d?", self.flag.x, self.flag.y, self.flag.is_on_tank))
+        digest.update(struct.pack("<%dq" % len(self.tanks_list), *self.scores()))
+        return digest.hexdigest()
+
+
+class FixedTimestep:
+    """ Runs the ticks of a match (or of anything with the same tick method,
+        like a replay player) at a fixed rate of game time, whatever the
+        rate at which frames are displayed. The time of each displayed frame
+        is accumulated and as many ticks as it contains are run; alpha tells
+        how far the display is between the last two ticks, for interpolation.
+    """
+
+    def __init__(self, match, max_ticks_per_frame=MAX_TICKS_PER_FRAME):
+        self.match = match
+        self.max_ticks_per_frame = max_ticks_per_frame
+        self.accumulator = 0.0
+        self.alpha = 1.0
+
+    def advance(self, frame_seconds):
+        """ Runs the ticks that fit in the time elapsed since the previous frame.
+            Returns the list of tanks that brought the flag home during those ticks.
+        """
+        tick_seconds = 1 / FRAMERATE
+        self.accumulator += frame_seconds
+        winners = []
+        ticks = 0
+        while self.accumulator >= tick_seconds:
+            if ticks == self.max_ticks_per_frame:
+                # Too far behind (the window was dragged, the machine is too slow...), drop the lag
+                self.accumulator = 0.0
+                break
+            winners += self.match.tick()
+            self.accumulator -= tick_seconds
+            ticks += 1
+        self.alpha = self.accumulator / tick_seconds
+        return winners
+
+
+def interpolate_state(previous, current, alpha):
+    """ Returns the screen position and orientation alpha of the way from
+        previous to current (both pairs of position and orientation in degrees).
+        Objects which jumped further than a tile (for instance a tank sent back
+        to its base) are not interpolated.
+    """
+    (previous_position, previous_angle), (position, angle) = previous, current
+    if (position - previous_position).length > gameobjects.physics_to_display(1):
+        return current
+    turn = (angle - previous_angle + 180) % 360 - 180
+    return previous_position + (position - previous_position) * alpha, previous_angle + turn * alpha
+
+
+def run_headless(current_map, seed=None, max_ticks=60 * FRAMERATE * 60, score_limit=1, ai_options=None, profiler=None):
+    """ Runs a match where every tank is controlled by an ai, as fast as possible,
+        until a tank reaches score_limit or max_ticks ticks have been simulated.
+        Returns a dictionary describing the result of the match.
+    """
+    match = Match(current_map, human_players=0, ai_options=ai_options, seed=seed, profiler=profiler)
+    return run_match(match, max_ticks, score_limit)
+
+
+def run_match(match, max_ticks=60 * FRAMERATE * 60, score_limit=1):
+    """ Runs an already created match as fast as possible, see run_headless. """
+    start = time.perf_counter()
+    while match.ticks < max_ticks and max(match.scores()) < score_limit:
+        match.tick()
+    elapsed = time.perf_counter() - start
+
+    scores = match.scores()
+    winner = scores.index(max(scores)) if max(scores) >= score_limit else None
+    return {
+        "ticks": match.ticks,
+        "scores": scores,
+        "winner": winner,
+        "seconds": elapsed,
+        "state_hash": match.state_hash(),
+    }
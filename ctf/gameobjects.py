@@ -1,6 +1,9 @@
 """ This module contains support for the different game objects: tank, boxes...
 """
 import math
+from collections import OrderedDict
+
+import numpy
 import pygame
 import pymunk
 import sounds
@@ -17,17 +20,67 @@ collision_types = {
     "tank": 5,      #Tanks are destroyed when hit by bullets
 }
 
+# Categories of the shapes of tanks and bullets (boxes are in every
+# category), so that segment queries can leave them out, see pymunk.ShapeFilter
+TANK_CATEGORY = 0b10
+BULLET_CATEGORY = 0b100
+
 def physics_to_display(x):
     """ This function is used to convert coordinates in the physic engine into the display coordinates """
     return x * images.TILE_SIZE
 
 
+class RotationCache:
+    """ Least recently used cache of rotated sprites, so that pygame.transform.rotate
+        is only called once per sprite and angle. Angles are rounded to a
+        multiple of resolution (in degrees) and at most max_size rotated
+        sprites are kept. hits and misses count how the lookups went.
+    """
+
+    def __init__(self, resolution=1.0, max_size=2048):
+        self.resolution = resolution
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def rotate(self, sprite, angle):
+        """ Returns the sprite rotated by angle degrees, and the offset from
+            its center to its top left corner.
+        """
+        steps = round(360 / self.resolution)
+        key = (sprite, round(angle / self.resolution) % steps)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        rotated = pygame.transform.rotate(sprite, key[1] * self.resolution)
+        entry = (rotated, pymunk.Vec2d(*rotated.get_size()) / 2.)
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """ Empties the cache, for instance after changing its resolution, and resets the counters. """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+rotation_cache = RotationCache()  # Shared by every GameObject
+
+
 class GameObject:
     """ Mostly handles visual aspects (pygame) of an object.
         Subclasses need to implement two functions:
         - screen_position    that will return the position of the object on the screen
         - screen_orientation that will return how much the object is rotated on the screen (in degrees). """
 
+    entity_id = None  # Given by the EntityRegistry the object is added to
+
     def __init__(self, sprite):
         self.sprite = sprite
 
@@ -41,22 +94,24 @@ class GameObject:
             other objects than itself."""
         return
 
-    def update_screen(self, screen):
+    def update_screen(self, screen, position=None, orientation=None):
         """ Updates the visual part of the game. Should NOT need to be changed
-            by a subclass."""
-        sprite = self.sprite
-
-        p = self.screen_position()  # Get the position of the object (pygame coordinates)
-        sprite = pygame.transform.rotate(sprite, self.screen_orientation())  # Rotate the sprite using the rotation of the object
+            by a subclass. Returns the area of the screen that was drawn on.
+            The object is drawn at its current position and orientation, unless
+            others are given (for instance to draw it between two ticks)."""
+        if position is None:
+            position, orientation = self.screen_position(), self.screen_orientation()
+        p = position  # Get the position of the object (pygame coordinates)
+        # Rotate the sprite using the rotation of the object
+        sprite, offset = rotation_cache.rotate(self.sprite, orientation)
 
         # The position of the screen correspond to the center of the object,
         # but the function screen.blit expect to receive the top left corner
         # as argument, so we need to adjust the position p with an offset
         # which is the vector between the center of the sprite and the top left
         # corner of the sprite
-        offset = pymunk.Vec2d(*sprite.get_size()) / 2.
         p = p - offset
-        screen.blit(sprite, p)  # Copy the sprite on the screen
+        return screen.blit(sprite, p)  # Copy the sprite on the screen
 
 
 class GamePhysicsObject(GameObject):
@@ -68,7 +123,8 @@ class GamePhysicsObject(GameObject):
     def __init__(self, x, y, orientation, sprite, space, movable):
         """ Takes as parameters the starting coordinate (x,y), the orientation, the sprite (aka the image
             representing the object), the physic engine object (space) and whether the object can be
-            moved (movable).
+            moved (movable). When space is None, the body and shape are not added to any space
+            (for instance rock boxes whose shape was merged with their neighbours, see engine.merge_rocks).
         """
 
         super().__init__(sprite)
@@ -105,7 +161,8 @@ class GamePhysicsObject(GameObject):
         # self.shape.elasticity = 0.1
 
         # Add the object to the physic engine
-        space.add(self.body, self.shape)
+        if space is not None:
+            space.add(self.body, self.shape)
 
     def screen_position(self):
         """ Converts the body's position in the physics engine to screen coordinates. """
@@ -115,15 +172,16 @@ class GamePhysicsObject(GameObject):
         """ Angles are reversed from the engine to the display. """
         return -math.degrees(self.body.angle)
 
-    def update_screen(self, screen):
-        super().update_screen(screen)
+    def update_screen(self, screen, position=None, orientation=None):
+        rect = super().update_screen(screen, position, orientation)
         # debug draw
         if DEBUG:
             ps = [self.body.position + p for p in self.points]
 
             ps = [physics_to_display(p) for p in ps]
             ps += [ps[0]]
-            pygame.draw.lines(screen, pygame.color.THECOLORS["red"], False, ps, 1)
+            rect = rect.union(pygame.draw.lines(screen, pygame.color.THECOLORS["red"], False, ps, 1))
+        return rect
 
 
 def clamp(min_max, value):
@@ -151,50 +209,62 @@ class Tank(GamePhysicsObject):
             self.start_position = pymunk.Vec2d(x,
                                                y)  # Define the start position, which is also the position where the tank has to return with the flag
             self.score = 0
+            self.input_listener = None  # Called with (tank, name, arguments) for every control method, for instance to record a replay
+            self.shape.filter = pymunk.ShapeFilter(categories=TANK_CATEGORY)
+
+        def notify_input(self, name, *args):
+            """ Tells the input listener, if any, that the control method name was called with args. """
+            if self.input_listener is not None:
+                self.input_listener(self, name, args)
 
         def accelerate(self):
             """ Call this function to make the tank move forward. """
-            sounds.movement_sound.stop()
-            sounds.engine_sound.stop()
-            sounds.movement_sound.play()
-            sounds.engine_sound.set_volume(0.2)
-            sounds.engine_sound.play()
+            self.notify_input("accelerate")
+            sounds.mixer.hold("movement_sound", self)
+            sounds.mixer.hold("engine_sound", self)
             self.acceleration = 1
 
         def stop_moving(self):
             """ Call this function to make the tank stop moving. """
-            sounds.movement_sound.stop()
-            sounds.engine_sound.stop()
-
-            sounds.engine_sound.set_volume(0.2)
-            sounds.engine_sound.play()
-
+            self.notify_input("stop_moving")
+            sounds.mixer.hold("movement_sound", self, False)
+            sounds.mixer.hold("engine_sound", self)
             self.acceleration = 0
             self.body.velocity = pymunk.Vec2d.zero()
 
         def decelerate(self):
             """ Call this function to make the tank move backward. """
-            sounds.movement_sound.stop()
-            sounds.engine_sound.stop()
-            sounds.movement_sound.play()
-            sounds.engine_sound.set_volume(0.2)
-            sounds.engine_sound.play()
-
+            self.notify_input("decelerate")
+            sounds.mixer.hold("movement_sound", self)
+            sounds.mixer.hold("engine_sound", self)
             self.acceleration = -1
 
         def turn_left(self):
             """ Makes the tank turn left (counter clock-wise). """
+            self.notify_input("turn_left")
             self.rotation = -1
 
         def turn_right(self):
             """ Makes the tank turn right (clock-wise). """
+            self.notify_input("turn_right")
             self.rotation = 1
 
         def stop_turning(self):
             """ Call this function to make the tank stop turning. """
+            self.notify_input("stop_turning")
             self.rotation = 0
             self.body.angular_velocity = 0
 
+        def align_position(self, x, y):
+            """ Moves the tank exactly to (x, y), for instance to the center of the tile it has reached. """
+            self.notify_input("align_position", x, y)
+            self.body.position = x, y
+
+        def align_angle(self, angle):
+            """ Turns the tank exactly to angle (in radians). """
+            self.notify_input("align_angle", angle)
+            self.body.angle = angle
+
         def ability_to_shoot(self):
             """ Call this function to check whether a tank can shoot or not """
             return self.shoot_last >= 50
@@ -238,20 +308,21 @@ class Tank(GamePhysicsObject):
                     self.flag = flag
                     flag.is_on_tank = True
                     self.max_speed = Tank.FLAG_MAX_SPEED
-                    sounds.flag_capture_sound.play()
+                    sounds.mixer.play("flag_capture_sound")
 
         def has_won(self):
             """ Check if the current tank has won (if it is has the flag and it is close to its start position). """
             return self.flag is not None and (self.start_position - self.body.position).length < 0.2
 
-        def shoot(self, space):
-            """ Call this function to shoot a missile (current implementation does nothing ! you need to implement it yourself) """
+        def shoot(self, bullets):
+            """ Call this function to shoot a missile, taken from bullets (the BulletPool of the game).
+                Returns the bullet, or None if the tank can not shoot yet.
+            """
             if Tank.ability_to_shoot(self):
+                self.notify_input("shoot")
                 self.shoot_last = 0
-                sounds.tankshot_sound.play()
-                bullet = Bullet(self, images.bullet, space)
-                bullet.shape.collision_type = collision_types["bullet"]
-                return bullet
+                sounds.mixer.play("tankshot_sound")
+                return bullets.fire(self)
             else:
                 return None
 
@@ -260,18 +331,27 @@ class Bullet(GamePhysicsObject):
     # You can add more constants here if needed later
 
     NORMAL_MAX_SPEED = 5.0
+    LIFETIME = 250  # Number of ticks (five seconds) after which a bullet that hit nothing is removed
 
     def __init__(self, tank, sprite, space):
-
-        x_start = tank.body.position.x + (0.4 * math.cos(math.radians(tank.screen_orientation()-90)))
-        y_start = tank.body.position.y + (0.4 * math.sin(math.radians(tank.screen_orientation()+90)))
-
-        super().__init__(x_start, y_start, tank.screen_orientation(), sprite, space, True)
+        super().__init__(0, 0, 0, sprite, space, True)
         # Define variable used to apply motion to the bullet
         self.speed = 5
-        self.body.velocity = pymunk.Vec2d((self.speed * math.cos(math.radians(tank.screen_orientation()-90))), self.speed * (math.sin(math.radians(tank.screen_orientation()+90))))
         self.space = space
         self.max_speed = Bullet.NORMAL_MAX_SPEED     # Impose a maximum speed to the bullet
+        self.index = None  # Position in the list of flying bullets of its BulletPool, None when not flying
+        self.expires = 0  # Tick of the BulletPool at which the bullet is removed
+        self.shape.filter = pymunk.ShapeFilter(categories=BULLET_CATEGORY)
+        self.aim(tank)
+
+    def aim(self, tank):
+        """ Places the bullet in front of the tank, flying in the direction the tank is facing. """
+        x_start = tank.body.position.x + (0.4 * math.cos(math.radians(tank.screen_orientation()-90)))
+        y_start = tank.body.position.y + (0.4 * math.sin(math.radians(tank.screen_orientation()+90)))
+        self.body.position = x_start, y_start
+        self.body.angle = math.radians(tank.screen_orientation())
+        self.body.velocity = pymunk.Vec2d((self.speed * math.cos(math.radians(tank.screen_orientation()-90))), self.speed * (math.sin(math.radians(tank.screen_orientation()+90))))
+        self.body.angular_velocity = 0
 
     def update(self):
         """ A function to update the objects coordinates. Gets called at every tick of the game. """
@@ -283,6 +363,114 @@ class Bullet(GamePhysicsObject):
         velocity = clamp(self.max_speed, self.body.velocity.length)
         self.body.velocity = pymunk.Vec2d(velocity, 0).rotated(self.body.velocity.angle)
 
+
+def clamp_velocities(vx, vy, max_speed):
+    """ Same as the end of Tank.update and Bullet.update for arrays of
+        velocities: returns them with their length bounded by max_speed,
+        computed through their angle like Vec2d.rotated and Vec2d.angle do.
+    """
+    speed = numpy.minimum(numpy.maximum(-max_speed, numpy.sqrt(vx ** 2 + vy ** 2)), max_speed)
+    heading = numpy.where(vx ** 2 + vy ** 2 == 0, 0.0, numpy.arctan2(vy, vx))
+    return speed * numpy.cos(heading), speed * numpy.sin(heading)
+
+
+def update_tanks(tanks):
+    """ Same as calling update on every tank, but computed on numpy arrays
+        holding the state of all the tanks at once.
+    """
+    if not tanks:
+        return
+    bodies = [tank.body for tank in tanks]
+    state = numpy.array([(body.angle, *body.velocity, body.angular_velocity, tank.acceleration, tank.rotation, tank.max_speed)
+                         for tank, body in zip(tanks, bodies)], dtype=float)
+    angle, vx, vy, angular_velocity, acceleration, rotation, max_speed = state.T
+
+    # Accelerate in the direction of the tank, like Vec2d(0, ACCELERATION * acceleration).rotated(angle)
+    thrust = Tank.ACCELERATION * acceleration
+    vx, vy = clamp_velocities(vx - thrust * numpy.sin(angle), vy + thrust * numpy.cos(angle), max_speed)
+    angular_velocity = numpy.minimum(numpy.maximum(-max_speed, angular_velocity + rotation * Tank.ACCELERATION), max_speed)
+
+    for body, x, y, w in zip(bodies, vx.tolist(), vy.tolist(), angular_velocity.tolist()):
+        body.velocity = x, y
+        body.angular_velocity = w
+
+
+def update_bullets(bullets):
+    """ Same as calling update on every bullet, but computed on numpy arrays
+        holding the velocities of all the bullets at once.
+    """
+    if not bullets:
+        return
+    bodies = [bullet.body for bullet in bullets]
+    state = numpy.array([(*body.velocity, bullet.max_speed, bullet.space.damping)
+                         for bullet, body in zip(bullets, bodies)], dtype=float)
+    vx, vy, max_speed, damping = state.T
+
+    damping_spacefctr = 1.0 / (1.0 - damping)
+    vx, vy = clamp_velocities(vx + damping_spacefctr * vx, vy + damping_spacefctr * vy, max_speed)
+
+    for body, x, y in zip(bodies, vx.tolist(), vy.tolist()):
+        body.velocity = x, y
+
+
+class BulletPool:
+    """ The bullets flying in a space. A bullet that hit something or flew for
+        lifetime ticks is removed from the space and kept, to be fired again
+        later instead of creating a new body and shape for every shot.
+        live is the list of flying bullets. Every bullet knows its index in
+        live, so that removing it only moves the last bullet to its place.
+    """
+
+    def __init__(self, space, lifetime=Bullet.LIFETIME):
+        self.space = space
+        self.lifetime = lifetime
+        self.live = []
+        self.free = []  # Bullets removed from the space, ready to be fired again
+        self.ticks = 0
+        self.created = 0  # Number of Bullet objects created, for statistics
+        self.fired = 0  # Number of bullets fired, every bullet fired gets the next serial number
+
+    def fire(self, tank):
+        """ Adds a bullet to the space, in front of the tank, and returns it. """
+        if self.free:
+            bullet = self.free.pop()
+            bullet.aim(tank)
+            self.space.add(bullet.body, bullet.shape)
+        else:
+            bullet = Bullet(tank, images.bullet, self.space)
+            bullet.shape.collision_type = collision_types["bullet"]
+            self.created += 1
+        bullet.expires = self.ticks + self.lifetime
+        bullet.serial = self.fired
+        self.fired += 1
+        bullet.index = len(self.live)
+        self.live.append(bullet)
+        return bullet
+
+    def release(self, bullet):
+        """ Removes a flying bullet from the space. Returns False if it was
+            already removed, for instance when it hit two objects during the
+            same step of the space.
+        """
+        index = bullet.index
+        if index is None:
+            return False
+        last = self.live.pop()
+        if last is not bullet:
+            self.live[index] = last
+            last.index = index
+        bullet.index = None
+        self.space.remove(bullet.shape, bullet.body)
+        self.free.append(bullet)
+        return True
+
+    def update(self):
+        """ Counts one more tick and removes the bullets which flew for lifetime ticks. """
+        self.ticks += 1
+        for bullet in [bullet for bullet in self.live if bullet.expires <= self.ticks]:
+            self.release(bullet)
+
+
 class Box(GamePhysicsObject):
     """ This class extends the GamePhysicsObject to handle box objects. """
 
@@ -333,3 +521,56 @@ class Flag(GameVisibleObject):
     def __init__(self, x, y):
         self.is_on_tank = False
         super().__init__(x, y, images.flag)
+
+
+class EntityRegistry:
+    """ The game objects of a match (boxes, bases and flag). Every object
+        added gets an id, which is never given to another object. Iterating
+        over the registry gives the objects in the order they were added (the
+        drawing order), and of_type gives the objects of a class in the same
+        order. Adding, removing and finding an object do not depend on the
+        number of objects.
+    """
+
+    def __init__(self):
+        self.objects = {}  # Id -> object, in the order they were added
+        self.types = {}  # Class -> {id: object} of the objects of that class or of its subclasses
+        self.next_id = 0
+
+    def add(self, obj):
+        """ Adds an object and returns its id. """
+        obj.entity_id = entity_id = self.next_id
+        self.next_id += 1
+        self.objects[entity_id] = obj
+        for cls in type(obj).__mro__[:-1]:  # Every class but object
+            self.types.setdefault(cls, {})[entity_id] = obj
+        return entity_id
+
+    def remove(self, obj):
+        """ Removes an object, raising KeyError if it is not in the registry. """
+        if self.objects.get(obj.entity_id) is not obj:
+            raise KeyError(obj)
+        del self.objects[obj.entity_id]
+        for cls in type(obj).__mro__[:-1]:
+            del self.types[cls][obj.entity_id]
+
+    def get(self, entity_id):
+        """ Returns the object with the given id, or None if it was removed. """
+        return self.objects.get(entity_id)
+
+    def of_type(self, cls):
+        """ Returns the objects of the class cls (or of a subclass), in the order they were added. """
+        return self.types.get(cls, {}).values()
+
+    def first(self, cls):
+        """ Returns the object of the class cls that was added first, or None. """
+        return next(iter(self.of_type(cls)), None)
+
+    def __contains__(self, obj):
+        return self.objects.get(getattr(obj, "entity_id", None)) is obj
+
+    def __iter__(self):
+        return iter(self.objects.values())
+
+    def __len__(self):
+        return len(self.objects)
@@ -1,44 +1,48 @@
 """ Graphics assests for the game
+    The images are loaded the first time they are used (see assets.py), so
+    that this module can be imported before the display is initialised.
 """
 
-import pygame
-import os
+import assets
 
-main_dir = os.path.split(os.path.abspath(__file__))[0]
+TILE_SIZE = assets.NATIVE_TILE_SIZE  # Define the default size of tiles, see set_tile_size
 
+manager = assets.AssetManager('data')
 
-def load_image(file):
-    """ Load an image from the data directory. """
-    file = os.path.join(main_dir, 'data', file)
-    try:
-        surface = pygame.image.load(file)
-    except pygame.error:
-        raise SystemExit('Could not load image "%s" %s' % (file, pygame.get_error()))
-    return surface.convert_alpha()
-
-
-TILE_SIZE = 40  # Define the default size of tiles
-
-explosion = load_image('explosion.png')  # Image of an explosion
-
-grass = load_image('grass.png')  # Image of a grass tile
+# File, size in native pixels (None for the size of the file) and rotation of every image
+IMAGES = {
+    'explosion': ('explosion.png', None, 0),  # Image of an explosion
+    'grass': ('grass.png', None, 0),  # Image of a grass tile
+    'rockbox': ('rockbox.png', None, 0),  # Image of a rock box (wall)
+    'metalbox': ('metalbox.png', None, 0),  # Image of a metal box
+    'woodbox': ('woodbox.png', None, 0),  # Image of a wood box
+    'flag': ('flag.png', None, 0),  # Image of flag
+    'bullet': ('bullet.png', (10, 10), -90),
+}
 
-rockbox = load_image('rockbox.png')  # Image of a rock box (wall)
+COLORS = ['orange', 'blue', 'white', 'yellow', 'red', 'gray']
 
-metalbox = load_image('metalbox.png')  # Image of a metal box
 
-woodbox = load_image('woodbox.png')  # Image of a wood box
-
-flag = load_image('flag.png')  # Image of flag
-
-bullet = load_image('bullet.png')
-bullet = pygame.transform.scale(bullet, (10, 10))
-bullet = pygame.transform.rotate(bullet, -90)
-
-# List of image of tanks of different colors
-tanks = [load_image('tank_orange.png'), load_image('tank_blue.png'), load_image('tank_white.png'),
-         load_image('tank_yellow.png'), load_image('tank_red.png'), load_image('tank_gray.png')]
-
-# List of image of bases corresponding to the color of each tank
-bases = [load_image('base_orange.png'), load_image('base_blue.png'), load_image('base_white.png'),
-         load_image('base_yellow.png'), load_image('base_red.png'), load_image('base_gray.png')]
+def load_image(file):
+    """ Load an image from the data directory. """
+    return manager.image(file)
+
+
+def set_tile_size(tile_size):
+    """ Changes the size of tiles on the screen, every image used from now on is scaled to it. """
+    global TILE_SIZE
+    TILE_SIZE = tile_size
+    manager.set_tile_size(tile_size)
+
+
+def __getattr__(name):
+    """ Returns the images of the module, loading them on first use. """
+    if name in IMAGES:
+        return manager.image(*IMAGES[name])
+    if name == 'tanks':
+        # List of image of tanks of different colors
+        return [manager.image(f'tank_{color}.png') for color in COLORS]
+    if name == 'bases':
+        # List of image of bases corresponding to the color of each tank
+        return [manager.image(f'base_{color}.png') for color in COLORS]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,138 @@
+""" Procedural generation of maps, mostly for testing the game on maps much
+    larger than the built-in ones.
+
+    Usage: python mapgen.py 200 200 --seed 1 --density 0.3 --output data/maps/large.ctfmap
+"""
+import argparse
+from collections import deque
+
+import numpy
+
+import maps
+
+MAX_SIZE = 500
+MAX_PLAYERS = 6  # There are only six tank and base images
+
+# Share of each box type among the generated boxes
+DEFAULT_BOX_MIX = {maps.ROCK: 0.5, maps.WOOD: 0.3, maps.METAL: 0.2}
+
+
+def start_positions(width, height, players):
+    """ Returns the tiles and orientations of the starting positions, placed
+        symmetrically: in the corners first, then in the middle of the top and
+        bottom rows (like map1), or in the middle of the left and right
+        columns for two players (like map2).
+    """
+    if players == 2:
+        return [(0, height // 2, 270), (width - 1, height // 2, 90)]
+    positions = [(0, 0, 0), (width - 1, 0, 0), (0, height - 1, 180), (width - 1, height - 1, 180),
+                 (width // 2, 0, 0), (width // 2, height - 1, 180)]
+    return positions[:players]
+
+
+def symmetric(quadrant, width, height):
+    """ Builds a (height, width) array which is symmetric with respect to both
+        axes of the map, from its top left quadrant of shape
+        (ceil(height / 2), ceil(width / 2)).
+    """
+    full = numpy.empty((height, width), dtype=quadrant.dtype)
+    qh, qw = quadrant.shape
+    full[:qh, :qw] = quadrant
+    full[:qh, width - qw:] = quadrant[:, ::-1]
+    full[height - qh:, :] = full[:qh, :][::-1]
+    return full
+
+
+def reachable(boxes, start):
+    """ Returns a boolean mask of the grass tiles reachable from start. """
+    height, width = boxes.shape
+    passable = (boxes == maps.GRASS).ravel().tolist()
+    seen = [False] * (width * height)
+    first = start[0] + start[1] * width
+    seen[first] = True
+    queue = deque([first])
+    while queue:
+        index = queue.popleft()
+        x = index % width
+        for neighbour in (index - width, index + width,
+                          index - 1 if x > 0 else -1, index + 1 if x + 1 < width else -1):
+            if 0 <= neighbour < width * height and not seen[neighbour] and passable[neighbour]:
+                seen[neighbour] = True
+                queue.append(neighbour)
+    return numpy.array(seen).reshape(height, width)
+
+
+def carve(boxes, start, end):
+    """ Clears an L shaped corridor of grass from start to end (along the row
+        of start, then along the column of end), together with its mirror
+        images so that the map stays symmetric.
+    """
+    (sx, sy), (ex, ey) = start, end
+    corridor = numpy.zeros(boxes.shape, dtype=bool)
+    corridor[sy, min(sx, ex):max(sx, ex) + 1] = True
+    corridor[min(sy, ey):max(sy, ey) + 1, ex] = True
+    boxes[corridor | corridor[::-1] | corridor[:, ::-1] | corridor[::-1, ::-1]] = maps.GRASS
+
+
+def generate_map(width, height, seed=None, density=0.3, players=4, box_mix=None):
+    """ Generates a map of the given size (up to MAX_SIZE x MAX_SIZE tiles).
+        density is the share of tiles covered by a box and box_mix the share
+        of each box type among the boxes. The boxes are symmetric with respect
+        to both axes of the map, so that no starting position is favoured, the
+        flag is in the middle (between the four middle tiles, which are grass,
+        when the width and height are even), and every starting position is
+        connected to the flag by grass tiles. The same seed always gives the same map.
+    """
+    if not (2 <= width <= MAX_SIZE and 2 <= height <= MAX_SIZE):
+        raise ValueError("Map size must be between 2x2 and %dx%d" % (MAX_SIZE, MAX_SIZE))
+    if not (1 <= players <= MAX_PLAYERS):
+        raise ValueError("A map can have between 1 and %d players" % MAX_PLAYERS)
+    if not (0 <= density <= 1):
+        raise ValueError("Box density must be between 0 and 1")
+    box_mix = box_mix or DEFAULT_BOX_MIX
+    rng = numpy.random.default_rng(seed)
+
+    # Draw the boxes of the top left quadrant and mirror them on the rest of the map
+    quadrant_shape = ((height + 1) // 2, (width + 1) // 2)
+    types = numpy.array(list(box_mix.keys()), dtype=numpy.int8)
+    weights = numpy.array(list(box_mix.values()), dtype=float)
+    quadrant = rng.choice(types, size=quadrant_shape, p=weights / weights.sum())
+    quadrant[rng.random(quadrant_shape) >= density] = maps.GRASS
+    boxes = symmetric(quadrant, width, height)
+
+    starts = start_positions(width, height, players)
+    # A tile under the flag, carve clears its mirror images too
+    flag = (width // 2, height // 2)
+    carve(boxes, flag, flag)
+    for x, y, _ in starts:
+        carve(boxes, (x, y), (x, y))
+
+    connected = reachable(boxes, flag)
+    for x, y, _ in starts:
+        if not connected[y, x]:
+            carve(boxes, (x, y), flag)
+            connected = reachable(boxes, flag)
+
+    return maps.Map(width, height, boxes,
+                    [[x + 0.5, y + 0.5, orientation] for x, y, orientation in starts],
+                    [width / 2, height / 2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a map and save it in the ctfmap format")
+    parser.add_argument("width", type=int)
+    parser.add_argument("height", type=int)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--density", type=float, default=0.3, help="share of tiles covered by a box")
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--output", required=True, help="file to save the map to")
+    args = parser.parse_args()
+
+    current_map = generate_map(args.width, args.height, args.seed, args.density, args.players)
+    maps.save_map(current_map, args.output)
+    print("Saved a %dx%d map with %s rock, wood and metal boxes to %s" % (
+        args.width, args.height, current_map.box_histogram()[1:].tolist(), args.output))
+
+
+if __name__ == "__main__":
+    main()
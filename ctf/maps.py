@@ -1,6 +1,15 @@
+import os
+import struct
+import zlib
+
 import images
+import numpy
 import pygame
 
+# Box types, as stored in Map.boxes
+GRASS, ROCK, WOOD, METAL = 0, 1, 2, 3
+BOX_TYPES = 4
+
 
 class Map:
     """ An instance of Map is a blueprint for how the game map will look. """
@@ -8,19 +17,199 @@ class Map:
     def __init__(self, width, height, boxes, start_positions, flag_position):
         """ Takes as argument the size of the map (width, height), an array with the boxes type,
         the start position of tanks (start_positions) and the position of the flag (flag_position).
+        The boxes are stored in a numpy array of shape (height, width), indexed as boxes[y, x].
         """
         self.width = width
         self.height = height
-        self.boxes = boxes
+        self.boxes = numpy.array(boxes, dtype=numpy.int8).reshape(height, width)
         self.start_positions = start_positions
         self.flag_position = flag_position
+        self.revision = 0  # Incremented every time a box is added, moved or removed
 
     def rect(self):
         return pygame.Rect(0, 0, images.TILE_SIZE * self.width, images.TILE_SIZE * self.height)
 
     def boxAt(self, x, y):
         """ Return the type of the box at coordinates (x, y). """
-        return self.boxes[y][x]
+        return int(self.boxes[y, x])
+
+    def set_box(self, x, y, box_type):
+        """ Change the type of the box at coordinates (x, y), for instance when it is destroyed or pushed. """
+        if self.boxes[y, x] != box_type:
+            self.boxes[y, x] = box_type
+            self.revision += 1
+
+    def copy(self):
+        """ Return a copy of the map whose boxes can be changed without affecting this map. """
+        return Map(self.width, self.height, self.boxes.copy(), self.start_positions, self.flag_position)
+
+    def passable_mask(self):
+        """ Return a boolean array of shape (height, width), True for the grass tiles. """
+        return self.boxes == GRASS
+
+    def neighbour_counts(self, mask=None):
+        """ Return, for every tile, how many of its four neighbours are set in
+            mask (by default the passable mask). Tiles outside the map count as unset.
+        """
+        if mask is None:
+            mask = self.passable_mask()
+        padded = numpy.pad(mask, 1).astype(numpy.int8)
+        return padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+
+    def box_histogram(self):
+        """ Return how many tiles there are of every box type, indexed by box type. """
+        return numpy.bincount(self.boxes.ravel(), minlength=BOX_TYPES)
+
+    def tiles_of_type(self, box_type):
+        """ Return the (x, y) coordinates of every tile with the given box type,
+            as an array of shape (n, 2) ordered by x then y.
+        """
+        return numpy.argwhere(self.boxes.T == box_type)
+
+
+class TileIndex:
+    """ The boxes on every tile of a map and the tile of every box. Adding,
+        moving and removing a box through the index also sets the box types
+        of the map, so both always agree. Every operation takes constant time.
+        When several boxes are on the same tile (a pushed box may briefly
+        overlap another tile's box), the last one to arrive is the one on the
+        tile, and the tile gets the type of the one before when it leaves.
+    """
+
+    def __init__(self, current_map):
+        self.map = current_map
+        self.width = current_map.width
+        self.height = current_map.height
+        self.tiles = {}  # x + y * width -> list of the boxes on the tile, in order of arrival
+        self.positions = {}  # Box -> (x, y, box type), in the order the boxes were added
+
+    def add(self, box, x, y, box_type):
+        """ Puts a box of the given type on tile (x, y). """
+        self.tiles.setdefault(x + y * self.width, []).append(box)
+        self.positions[box] = (x, y, box_type)
+        self.map.set_box(x, y, box_type)
+
+    def at(self, x, y):
+        """ Returns the box on tile (x, y), or None for grass and tiles outside the map. """
+        if 0 <= x < self.width and 0 <= y < self.height:
+            boxes = self.tiles.get(x + y * self.width)
+            if boxes:
+                return boxes[-1]
+        return None
+
+    def tile_of(self, box):
+        """ Returns the (x, y) tile of a box of the index. """
+        x, y, _ = self.positions[box]
+        return x, y
+
+    def move(self, box, x, y):
+        """ Moves a box to tile (x, y). Returns False if it already was on that tile. """
+        old_x, old_y, box_type = self.positions[box]
+        if old_x == x and old_y == y:
+            return False
+        self.clear_tile(box, old_x, old_y)
+        self.add(box, x, y, box_type)
+        return True
+
+    def remove(self, box):
+        """ Removes a box from the index and returns its tile. """
+        x, y, _ = self.positions.pop(box)
+        self.clear_tile(box, x, y)
+        return x, y
+
+    def clear_tile(self, box, x, y):
+        """ Takes box off tile (x, y), which gets the type of the last box
+            left on it, or grass if there is none.
+        """
+        index = x + y * self.width
+        boxes = self.tiles[index]
+        boxes.remove(box)
+        if boxes:
+            self.map.set_box(x, y, self.positions[boxes[-1]][2])
+        else:
+            del self.tiles[index]
+            self.map.set_box(x, y, GRASS)
+
+    def __contains__(self, box):
+        return box in self.positions
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+
+# -- Map files
+# A .ctfmap file is little endian and made of:
+#  - a header: the magic bytes "CTFM", the format version (byte), the width
+#    and height (unsigned shorts) and the number of start positions (byte),
+#  - every start position as three floats (x, y, orientation),
+#  - the flag position as two floats (x, y),
+#  - the boxes, row by row, packed on two bits per tile (four tiles per byte,
+#    first tile in the lowest bits) and compressed with zlib.
+MAP_FILE_MAGIC = b"CTFM"
+MAP_FILE_VERSION = 1
+MAP_FILE_HEADER = struct.Struct("<4sBHHB")
+
+
+def map_to_bytes(current_map):
+    """ Return the map encoded in the .ctfmap format. """
+    tiles = current_map.boxes.ravel().astype(numpy.uint8)
+    tiles = numpy.pad(tiles, (0, -len(tiles) % 4)).reshape(-1, 4)
+    packed = tiles[:, 0] | (tiles[:, 1] << 2) | (tiles[:, 2] << 4) | (tiles[:, 3] << 6)
+    data = [MAP_FILE_HEADER.pack(MAP_FILE_MAGIC, MAP_FILE_VERSION, current_map.width,
+                                 current_map.height, len(current_map.start_positions))]
+    for x, y, orientation in current_map.start_positions:
+        data.append(struct.pack("<3f", x, y, orientation))
+    data.append(struct.pack("<2f", *current_map.flag_position))
+    data.append(zlib.compress(packed.astype(numpy.uint8).tobytes(), 9))
+    return b"".join(data)
+
+
+def map_from_bytes(data):
+    """ Return the map encoded in data, in the .ctfmap format. """
+    magic, version, width, height, players = MAP_FILE_HEADER.unpack_from(data)
+    if magic != MAP_FILE_MAGIC or version != MAP_FILE_VERSION:
+        raise ValueError("Not a map in the ctfmap format")
+    offset = MAP_FILE_HEADER.size
+    start_positions = []
+    for i in range(players):
+        start_positions.append(list(struct.unpack_from("<3f", data, offset)))
+        offset += struct.calcsize("<3f")
+    flag_position = list(struct.unpack_from("<2f", data, offset))
+    offset += struct.calcsize("<2f")
+    packed = numpy.frombuffer(zlib.decompress(data[offset:]), dtype=numpy.uint8)
+    tiles = numpy.stack([packed & 3, (packed >> 2) & 3, (packed >> 4) & 3, packed >> 6], axis=1).ravel()
+    return Map(width, height, tiles[:width * height], start_positions, flag_position)
+
+
+def save_map(current_map, file):
+    """ Save the map to a .ctfmap file. """
+    with open(file, "wb") as f:
+        f.write(map_to_bytes(current_map))
+
+
+def load_map(file):
+    """ Load a map from a .ctfmap file. """
+    with open(file, "rb") as f:
+        data = f.read()
+    try:
+        return map_from_bytes(data)
+    except ValueError:
+        raise ValueError('"%s" is not a map file' % file)
+
+
+def get_map(name):
+    """ Return the built-in map called name (for instance "map0"), or the map
+        stored in the file name if it is a path to a .ctfmap file.
+    """
+    if name.endswith(".ctfmap") or os.path.isfile(name):
+        return load_map(name)
+    current_map = globals().get(name)
+    if not isinstance(current_map, Map):
+        raise ValueError('Unknown map "%s"' % name)
+    return current_map
 
 
 map0 = Map(9, 9,
@@ -0,0 +1,228 @@
+""" Network protocol of the multiplayer server (see server.py), and a client for it.
+    Every message is a MESSAGE_HEADER (length of the payload and type)
+    followed by its payload:
+    - JOIN (client): protocol version and name of the room to play in
+    - WELCOME (server): index of the tank of the player (-1 when every seat
+      of the room is taken and the client only watches) and the map in the
+      ctfmap format
+    - INPUT (client): a control method of the tank, encoded like in replays
+    - SNAPSHOT (server): the number of inputs of the client applied so far
+      and the tick the last one was applied at (INPUT_ACK), followed by the
+      state of the match at one tick, see encode_snapshot
+    - ACK (client): tick of the last snapshot received, which the next
+      snapshots are encoded against
+
+    A snapshot holds the quantized positions of the tanks, bullets, wood and
+    metal boxes and the flag: positions in 1/POSITION_SCALE of a tile and
+    angles in 1/ANGLE_STEPS of a turn. Bullets have a serial number, so that
+    a client can tell which bullet is which. Tanks and boxes are only sent when
+    they changed since the last snapshot the client acknowledged, which is
+    most of them since boxes rarely move.
+"""
+import asyncio
+import math
+import struct
+import zlib
+
+import numpy
+
+import maps
+import replay
+
+PROTOCOL_VERSION = 3
+MESSAGE_HEADER = struct.Struct("<IB")  # Length of the payload, type
+MAX_MESSAGE = 1 << 24  # Longer messages are not accepted
+
+JOIN, WELCOME, INPUT, SNAPSHOT, ACK = range(1, 6)
+
+POSITION_SCALE = 256
+ANGLE_STEPS = 1 << 16
+
+# Columns of the arrays of a quantized state, the rows of tanks and boxes
+# are in the same order in every snapshot of a match
+KINDS = {
+    "tanks": ("x", "y", "angle", "score", "has_flag"),
+    "boxes": ("alive", "x", "y", "angle"),
+    "bullets": ("id", "x", "y", "angle"),
+    "flag": ("x", "y", "on_tank"),
+}
+ANGLE_COLUMNS = {kind: [i for i, column in enumerate(columns) if column == "angle"] for kind, columns in KINDS.items()}
+POSITION_COLUMNS = {kind: [i for i, column in enumerate(columns) if column in ("x", "y")] for kind, columns in KINDS.items()}
+DELTA_KINDS = ("tanks", "boxes")  # The other kinds are always sent whole
+NO_BASELINE = 0xFFFFFFFF
+SNAPSHOT_HEADER = struct.Struct("<II")  # Tick, tick of the baseline or NO_BASELINE
+ROWS = struct.Struct("<IB")  # Number of rows, whether they are a delta
+INPUT_ACK = struct.Struct("<II")  # Number of inputs applied, tick of the last one
+
+
+def message(kind, payload=b""):
+    """ Returns a message of the given type, ready to be written to a stream. """
+    return MESSAGE_HEADER.pack(len(payload), kind) + payload
+
+
+async def read_message(reader):
+    """ Reads the next message from a stream and returns (type, payload).
+        Raises asyncio.IncompleteReadError when the connection is closed.
+    """
+    length, kind = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ValueError("Message of %d bytes is too long" % length)
+    return kind, await reader.readexactly(length)
+
+
+def encode_input(name, args=()):
+    code = replay.INPUT_CODES[name]
+    return struct.pack("<B" + replay.INPUTS[code][1], code, *args)
+
+
+def decode_input(payload):
+    """ Returns the name and arguments of an INPUT message.
+        Raises ValueError when the message is not a valid input.
+    """
+    if not payload:
+        raise ValueError("Empty input")
+    code = payload[0]
+    if code >= len(replay.INPUTS):
+        raise ValueError("Unknown input %d" % code)
+    name, args_format = replay.INPUTS[code]
+    try:
+        return name, struct.unpack_from("<" + args_format, payload, 1)
+    except struct.error:
+        raise ValueError("Input %s is too short" % name)
+
+
+def quantize_position(value):
+    return round(value * POSITION_SCALE)
+
+
+def quantize_angle(angle):
+    return round(angle % (2 * math.pi) * ANGLE_STEPS / (2 * math.pi)) % ANGLE_STEPS
+
+
+def quantize_state(match, boxes):
+    """ Returns the state of the match sent to the clients, as a dictionary of
+        int32 arrays with the columns of KINDS. boxes is the list of the wood
+        and metal boxes created at the start of the match (match.movable_boxes()).
+    """
+    rows = {
+        "tanks": [(quantize_position(tank.body.position.x), quantize_position(tank.body.position.y),
+                   quantize_angle(tank.body.angle), tank.score, tank.flag is not None) for tank in match.tanks_list],
+        "boxes": [(box in match.boxes, quantize_position(box.body.position.x), quantize_position(box.body.position.y),
+                   quantize_angle(box.body.angle)) for box in boxes],
+        "bullets": [(bullet.serial, quantize_position(bullet.body.position.x), quantize_position(bullet.body.position.y),
+                     quantize_angle(bullet.body.angle)) for bullet in match.bullet_list],
+        "flag": [(quantize_position(match.flag.x), quantize_position(match.flag.y), match.flag.is_on_tank)],
+    }
+    return {kind: numpy.array(rows[kind], dtype=numpy.int32).reshape(-1, len(columns))
+            for kind, columns in KINDS.items()}
+
+
+def dequantize(kind, rows):
+    """ Returns rows of a quantized state as floats, with positions in tiles and angles in radians. """
+    rows = rows.astype(float)
+    rows[:, POSITION_COLUMNS[kind]] /= POSITION_SCALE
+    rows[:, ANGLE_COLUMNS[kind]] *= 2 * math.pi / ANGLE_STEPS
+    return rows
+
+
+def encode_snapshot(tick, state, baseline_tick=None, baseline=None):
+    """ Encodes a quantized state. When the baseline (the state at
+        baseline_tick, which the client has) is given, only the rows of
+        DELTA_KINDS which changed since then are included, with a bit mask
+        of those rows.
+    """
+    parts = [SNAPSHOT_HEADER.pack(tick, NO_BASELINE if baseline is None else baseline_tick)]
+    for kind in KINDS:
+        rows = state[kind]
+        if baseline is not None and kind in DELTA_KINDS and baseline[kind].shape == rows.shape:
+            changed = (rows != baseline[kind]).any(axis=1)
+            parts += [ROWS.pack(len(rows), True), numpy.packbits(changed).tobytes(), rows[changed].tobytes()]
+        else:
+            parts += [ROWS.pack(len(rows), False), rows.tobytes()]
+    return zlib.compress(b"".join(parts), 1)
+
+
+def decode_snapshot(data, baselines):
+    """ Decodes a snapshot and returns (tick, state). baselines maps the ticks
+        of the states received before to those states; a delta snapshot is
+        applied to a copy of its baseline.
+    """
+    data = zlib.decompress(data)
+    tick, baseline_tick = SNAPSHOT_HEADER.unpack_from(data)
+    baseline = None if baseline_tick == NO_BASELINE else baselines[baseline_tick]
+    offset = SNAPSHOT_HEADER.size
+    state = {}
+    for kind, columns in KINDS.items():
+        count, delta = ROWS.unpack_from(data, offset)
+        offset += ROWS.size
+        if delta:
+            mask_size = (count + 7) // 8
+            changed = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8, mask_size, offset), count=count).astype(bool)
+            offset += mask_size
+            rows = baseline[kind].copy()
+            size = int(changed.sum()) * len(columns)
+            rows[changed] = numpy.frombuffer(data, numpy.int32, size, offset).reshape(-1, len(columns))
+        else:
+            size = count * len(columns)
+            rows = numpy.frombuffer(data, numpy.int32, size, offset).reshape(-1, len(columns)).copy()
+        offset += size * 4
+        state[kind] = rows
+    return tick, state
+
+
+class Client:
+    """ A player (or spectator) connected to a server. Snapshots are received
+        with receive(), which acknowledges them so that the server sends the
+        next ones as deltas, and inputs are sent with send_input.
+    """
+
+    BASELINES = 64  # Number of received states kept as baselines, more than the server keeps
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.tank = None  # Index of the tank of the player, -1 for a spectator
+        self.current_map = None
+        self.states = {}  # Tick -> state received for that tick
+        self.tick = None
+        self.inputs_sent = 0
+        self.input_ack = 0  # Number of inputs the server applied, see INPUT_ACK
+        self.input_tick = 0
+
+    async def connect(self, host, port, room="default"):
+        """ Joins the room and waits for the welcome of the server. """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(message(JOIN, struct.pack("<B", PROTOCOL_VERSION) + room.encode()))
+        kind, payload = await read_message(self.reader)
+        if kind != WELCOME:
+            raise ValueError("Expected a welcome from the server, got message %d" % kind)
+        (self.tank,) = struct.unpack_from("<b", payload)
+        self.current_map = maps.map_from_bytes(payload[1:])
+
+    def send_input(self, name, *args):
+        """ Calls the control method name of the tank of the player on the
+            server. Returns the number of the input, counted from 1, which
+            input_ack reaches when the server has applied it.
+        """
+        self.writer.write(message(INPUT, encode_input(name, args)))
+        self.inputs_sent += 1
+        return self.inputs_sent
+
+    async def receive(self):
+        """ Waits for the next snapshot and returns (tick, state). """
+        while True:
+            kind, payload = await read_message(self.reader)
+            if kind == SNAPSHOT:
+                break
+        self.input_ack, self.input_tick = INPUT_ACK.unpack_from(payload)
+        tick, state = decode_snapshot(payload[INPUT_ACK.size:], self.states)
+        self.states[tick] = state
+        if len(self.states) > self.BASELINES:
+            del self.states[next(iter(self.states))]
+        self.tick = tick
+        self.writer.write(message(ACK, struct.pack("<I", tick)))
+        return tick, state
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
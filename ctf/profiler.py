@@ -0,0 +1,174 @@
+""" Timing of every phase of a match and of the main loop.
+    A Profiler keeps the last durations of each phase (the ticks of
+    Match.tick, the passes of the Renderer, the parts of a frame in ctf.py and
+    the decisions of every ai), counts the calls of the collision handlers and
+    the number of objects in the match. The results are available as rolling
+    percentiles, on screen, or written to a JSON or CSV file.
+
+    Code that is timed takes a start time from clock() and calls
+    lap(phase, start) at the end of each phase, which returns the start time
+    of the next phase. NULL_PROFILER does nothing, so that code does not have
+    to check whether profiling is enabled.
+"""
+import csv
+import json
+import time
+from collections import Counter, deque
+
+import numpy
+
+WINDOW = 500  # Number of durations of each phase the percentiles are computed on
+PERCENTILES = (50, 95, 99)
+OVERLAY_REFRESH = 25  # The overlay text is only rendered again every OVERLAY_REFRESH frames
+
+
+class Profiler:
+    """ Records the durations of the phases of the game loop. """
+    enabled = True
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.samples = {}  # Last durations of every phase, in seconds
+        self.totals = Counter()  # Time spent in every phase since the beginning
+        self.calls = Counter()  # Number of times every phase was timed
+        self.collisions = Counter()  # Number of calls of every collision handler
+        self.gauges = {}  # Last value of every object count
+        self.peaks = {}  # Largest value of every object count
+        self.ai_phases = {}
+        self.overlay_surface = None
+        self.overlay_frames = 0
+
+    def clock(self):
+        return time.perf_counter()
+
+    def record(self, phase, seconds):
+        samples = self.samples.get(phase)
+        if samples is None:
+            samples = self.samples[phase] = deque(maxlen=self.window)
+        samples.append(seconds)
+        self.totals[phase] += seconds
+        self.calls[phase] += 1
+
+    def lap(self, phase, start):
+        """ Records the time since start as a duration of phase and returns the current time. """
+        now = time.perf_counter()
+        self.record(phase, now - start)
+        return now
+
+    def lap_ai(self, index, start):
+        """ Same as lap, for the decision of the ai of the tank with the given index. """
+        phase = self.ai_phases.get(index)
+        if phase is None:
+            phase = self.ai_phases[index] = f"ai.{index + 1}"
+        return self.lap(phase, start)
+
+    def counted(self, name, collision_function):
+        """ Returns the collision function, wrapped so that its calls are counted under name. """
+        collisions = self.collisions
+
+        def counted_collision(arb, space, data):
+            collisions[name] += 1
+            return collision_function(arb, space, data)
+        return counted_collision
+
+    def gauge(self, name, value):
+        """ Records the current value of an object count. """
+        self.gauges[name] = value
+        if value > self.peaks.get(name, value - 1):
+            self.peaks[name] = value
+
+    def percentiles(self, phase):
+        """ Returns the mean, the PERCENTILES and the maximum of the last durations of phase, in milliseconds. """
+        samples = numpy.fromiter(self.samples[phase], dtype=float) * 1000
+        stats = {"mean": float(samples.mean())}
+        for percentile, value in zip(PERCENTILES, numpy.percentile(samples, PERCENTILES)):
+            stats[f"p{percentile}"] = float(value)
+        stats["max"] = float(samples.max())
+        return stats
+
+    def report(self):
+        """ Returns every measure as a dictionary that can be written as JSON. """
+        phases = {}
+        for phase in sorted(self.samples):
+            phases[phase] = dict(self.percentiles(phase), calls=self.calls[phase],
+                                 total=self.totals[phase] * 1000)
+        return {
+            "window": self.window,
+            "phases": phases,
+            "collisions": dict(sorted(self.collisions.items())),
+            "objects": {name: {"last": value, "peak": self.peaks[name]} for name, value in sorted(self.gauges.items())},
+        }
+
+    def save(self, file):
+        """ Writes the report to file, as CSV if its name ends with .csv and as JSON otherwise.
+            The CSV file has one row per phase, collision handler and object count.
+        """
+        report = self.report()
+        if not file.endswith(".csv"):
+            with open(file, "w") as f:
+                json.dump(report, f, indent=2)
+            return
+        columns = ["kind", "name", "calls", "total", "mean"] + [f"p{p}" for p in PERCENTILES] + ["max", "last", "peak"]
+        with open(file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for phase, stats in report["phases"].items():
+                writer.writerow(dict(stats, kind="phase", name=phase))
+            for name, calls in report["collisions"].items():
+                writer.writerow({"kind": "collision", "name": name, "calls": calls})
+            for name, values in report["objects"].items():
+                writer.writerow(dict(values, kind="objects", name=name))
+
+    def summary(self):
+        """ Returns the percentiles of every phase as lines of text, in milliseconds. """
+        lines = ["%-16s %8s %8s %8s %8s" % (("phase",) + tuple(f"p{p}" for p in PERCENTILES) + ("max",))]
+        for phase in sorted(self.samples):
+            stats = self.percentiles(phase)
+            lines.append("%-16s %8.3f %8.3f %8.3f %8.3f" % (
+                phase, *(stats[f"p{p}"] for p in PERCENTILES), stats["max"]))
+        if self.gauges:
+            lines.append("  ".join(f"{name}: {value}" for name, value in sorted(self.gauges.items())))
+        return lines
+
+    def draw_overlay(self, screen):
+        """ Draws the summary in the top left corner of the screen and returns the rect drawn on. """
+        import pygame
+
+        if self.overlay_surface is None or self.overlay_frames % OVERLAY_REFRESH == 0:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            font = pygame.font.SysFont("monospace", 12)
+            lines = [font.render(line, True, (255, 255, 255)) for line in self.summary()]
+            width = max(line.get_width() for line in lines)
+            surface = pygame.Surface((width + 8, sum(line.get_height() for line in lines) + 8), pygame.SRCALPHA)
+            surface.fill((0, 0, 0, 160))
+            y = 4
+            for line in lines:
+                surface.blit(line, (4, y))
+                y += line.get_height()
+            self.overlay_surface = surface
+        self.overlay_frames += 1
+        return screen.blit(self.overlay_surface, (0, 0))
+
+
+class NullProfiler:
+    """ A profiler which records nothing, used when profiling is disabled. """
+    enabled = False
+
+    def clock(self):
+        return 0.0
+
+    def lap(self, phase, start):
+        return start
+
+    def lap_ai(self, index, start):
+        return start
+
+    def counted(self, name, collision_function):
+        return collision_function
+
+    def gauge(self, name, value):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,133 @@
+""" Layered drawing of a match.
+    Everything that does not move (the grass, the rock boxes, the bases and
+    the wood and metal boxes that were never pushed) is drawn once on a
+    static layer. Every frame, only the areas covered by the moving objects
+    are restored from that layer, the moving objects are drawn again, and only
+    those areas of the display are updated.
+    Frames are not always identical to a full redraw: the moving objects are
+    drawn over the static layer (the flag over a box it overlaps, for
+    instance), and a box at rest which crept by a fraction of a pixel is not
+    noticed, so it may stay a pixel off until the static layer is rebuilt.
+"""
+import pygame
+
+import engine
+import gameobjects
+
+
+def is_static(obj):
+    """ Returns True for the objects that can never move: rock boxes and bases. """
+    if isinstance(obj, gameobjects.Flag):
+        return False
+    if isinstance(obj, gameobjects.GameVisibleObject):
+        return True
+    return obj.body.body_type == obj.body.STATIC
+
+
+class Renderer:
+    """ Draws a match on the screen using a cached static layer and dirty rectangles.
+        The passes of every frame are timed by the profiler of the match, which
+        is also drawn on top of the match when overlay is set.
+    """
+
+    def __init__(self, screen, match, background, overlay=False):
+        self.screen = screen
+        self.match = match
+        self.background = background
+        self.overlay = overlay
+        self.static_layer = None
+        self.baked = {}  # Wood and metal boxes drawn on the static layer, with their position when drawn
+        self.moved = set()  # Wood and metal boxes which have moved since the game started
+        self.moving_objects = []  # Game objects which are not on the static layer
+        self.dirty_rects = []  # Areas drawn on during the previous frame
+        self.revision = None
+        self.flag = None
+        self.alpha = 1.0
+        self.rebuilds = 0
+
+    def rebuild(self):
+        """ Draws the static layer again, with every box that has not moved yet. """
+        self.static_layer = self.background.copy()
+        self.baked = {}
+        for obj in self.match.game_objects:
+            if is_static(obj):
+                obj.update_screen(self.static_layer)
+            elif isinstance(obj, gameobjects.Box) and obj not in self.moved:
+                obj.update_screen(self.static_layer)
+                self.baked[obj] = (obj.body.position, obj.body.angle)
+        self.rebuilds += 1
+
+    def static_layer_is_valid(self):
+        """ Checks whether every box on the static layer is still where it was
+            drawn. Boxes which have moved are drawn as moving objects from now on.
+            Only the boxes touched since they were at rest (match.moving_boxes)
+            and, when a box was destroyed, the game objects are checked.
+        """
+        valid = True
+        if self.revision != self.match.current_map.revision:
+            if any(box not in self.match.game_objects for box in self.baked):
+                valid = False
+        for box in self.match.moving_boxes.keys() & self.baked.keys():
+            position, angle = self.baked[box]
+            if box.body.position != position or box.body.angle != angle:
+                self.moved.add(box)
+                valid = False
+        return valid
+
+    def update_moving_objects(self):
+        """ Finds the game objects which have to be drawn every
+            frame. This only changes when a box is destroyed or moved, or the flag is replaced.
+        """
+        self.moving_objects = [obj for obj in self.match.game_objects
+                               if not is_static(obj) and obj not in self.baked]
+        self.revision = self.match.current_map.revision
+        self.flag = self.match.flag
+
+    def draw(self, alpha=1.0):
+        """ Draws the current frame and updates the display. alpha tells how
+            far the frame is between the previous tick and the last one, when
+            the match saves its previous states.
+        """
+        self.alpha = alpha
+        profiler = self.match.profiler
+        start = profiler.clock()
+        if self.static_layer is None or not self.static_layer_is_valid():
+            self.rebuild()
+            self.update_moving_objects()
+            self.screen.blit(self.static_layer, (0, 0))
+            start = profiler.lap("draw.rebuild", start)
+            self.draw_moving_objects()
+            start = profiler.lap("draw.objects", start)
+            pygame.display.flip()
+            profiler.lap("draw.display", start)
+            return
+
+        if self.revision != self.match.current_map.revision or self.flag is not self.match.flag:
+            self.update_moving_objects()
+
+        # Erase the moving objects of the previous frame
+        previous_rects = self.dirty_rects
+        for rect in previous_rects:
+            self.screen.blit(self.static_layer, rect, rect)
+        start = profiler.lap("draw.erase", start)
+        self.draw_moving_objects()
+        start = profiler.lap("draw.objects", start)
+        pygame.display.update(previous_rects + self.dirty_rects)
+        profiler.lap("draw.display", start)
+
+    def draw_moving_objects(self):
+        """ Draws every object which is not on the static layer and remembers where. """
+        rects = []
+        for obj in self.moving_objects + self.match.tanks_list + self.match.bullet_list:
+            rects.append(self.draw_object(obj))
+        if self.overlay:
+            rects.append(self.match.profiler.draw_overlay(self.screen))
+        self.dirty_rects = rects
+
+    def draw_object(self, obj):
+        """ Draws an object, between its previous and current state if the match saved the previous one. """
+        previous = self.match.previous_states.get(obj)
+        if previous is None or self.alpha >= 1.0:
+            return obj.update_screen(self.screen)
+        current = (obj.screen_position(), obj.screen_orientation())
+        return obj.update_screen(self.screen, *engine.interpolate_state(previous, current, self.alpha))
@@ -0,0 +1,329 @@
+""" Recording and playback of matches.
+    A replay stores the map, the seed and every call to the control methods
+    of the tanks (made from the keyboard or by an ai) with the tick at which
+    it happened. Since the simulation is deterministic, playing these inputs
+    back on a new match gives the same match again, without any ai.
+    Every KEYFRAME_INTERVAL ticks the state of the match is also saved, so
+    that playback can jump to any tick without simulating everything before it.
+
+    Usage: python replay.py match.ctfreplay [--headless] [--speed 4] [--seek 3000]
+"""
+import argparse
+import math
+import struct
+import zlib
+
+import engine
+import images
+import maps
+
+KEYFRAME_INTERVAL = 500  # Ten seconds of game time
+
+REPLAY_MAGIC = b"CTFR"
+REPLAY_VERSION = 3
+# Magic, version, seed (ignored unless has_seed), has_seed, substeps, number of ticks, compact world, spatial hash
+REPLAY_HEADER = struct.Struct("<4sBq?BI??")
+
+# Control methods of the tanks, and the format of their arguments
+INPUTS = [
+    ("accelerate", ""),
+    ("decelerate", ""),
+    ("stop_moving", ""),
+    ("turn_left", ""),
+    ("turn_right", ""),
+    ("stop_turning", ""),
+    ("shoot", ""),
+    ("align_position", "2d"),
+    ("align_angle", "d"),
+]
+INPUT_CODES = {name: code for code, (name, _) in enumerate(INPUTS)}
+
+TANK_STATE = struct.Struct("<6d2bi d i b")  # position, angle, velocity, angular velocity, acceleration, rotation, shoot_last, max_speed, score, carried flag
+BOX_STATE = struct.Struct("<?6d")  # alive, position, angle, velocity, angular velocity
+BULLET_STATE = struct.Struct("<6di")  # position, angle, velocity, angular velocity, remaining ticks
+FLAG_STATE = struct.Struct("<3d?")  # position, orientation, is_on_tank
+
+
+class Replay:
+    """ The inputs and keyframes of a recorded match. events maps a tick to
+        the list of (tank index, input name, arguments) that happened before it.
+    """
+
+    def __init__(self, map_data, seed, substeps, compact_world=False, spatial_hash=False):
+        self.map_data = map_data  # The map when the match started, in the ctfmap format
+        self.seed = seed
+        self.substeps = substeps
+        self.compact_world = compact_world  # Options of the space of the match, see engine.Match
+        self.spatial_hash = spatial_hash
+        self.ticks = 0
+        self.events = {}
+        self.keyframes = {}  # Tick -> encoded state of the match before that tick
+
+    def create_match(self):
+        """ Creates the match as it was when the recording started, with every tank controlled by the replay. """
+        current_map = maps.map_from_bytes(self.map_data)
+        return engine.Match(current_map, human_players=len(current_map.start_positions),
+                            seed=self.seed, substeps=self.substeps, compact_world=self.compact_world,
+                            spatial_hash=self.spatial_hash)
+
+    def save(self, file):
+        """ Writes the replay to a file. """
+        events = bytearray()
+        previous_tick = 0
+        for tick in sorted(self.events):
+            tick_events = self.events[tick]
+            events += struct.pack("<IH", tick - previous_tick, len(tick_events))
+            for tank, name, args in tick_events:
+                code = INPUT_CODES[name]
+                events += struct.pack("<BB" + INPUTS[code][1], tank, code, *args)
+            previous_tick = tick
+        keyframes = bytearray(struct.pack("<I", len(self.keyframes)))
+        for tick in sorted(self.keyframes):
+            keyframes += struct.pack("<II", tick, len(self.keyframes[tick])) + self.keyframes[tick]
+
+        with open(file, "wb") as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed or 0,
+                                       self.seed is not None, self.substeps, self.ticks,
+                                       self.compact_world, self.spatial_hash))
+            for block in (self.map_data, zlib.compress(bytes(events), 9), zlib.compress(bytes(keyframes), 9)):
+                f.write(struct.pack("<I", len(block)))
+                f.write(block)
+
+    @classmethod
+    def load(cls, file):
+        """ Reads a replay written by save. """
+        with open(file, "rb") as f:
+            data = f.read()
+        magic, version, seed, has_seed, substeps, ticks, compact_world, spatial_hash = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError('"%s" is not a replay file' % file)
+        offset = REPLAY_HEADER.size
+        blocks = []
+        for i in range(3):
+            (length,) = struct.unpack_from("<I", data, offset)
+            blocks.append(data[offset + 4:offset + 4 + length])
+            offset += 4 + length
+        replay = cls(blocks[0], seed if has_seed else None, substeps, compact_world, spatial_hash)
+        replay.ticks = ticks
+
+        events = zlib.decompress(blocks[1])
+        offset, tick = 0, 0
+        while offset < len(events):
+            delta, count = struct.unpack_from("<IH", events, offset)
+            offset += 6
+            tick += delta
+            tick_events = replay.events.setdefault(tick, [])
+            for i in range(count):
+                tank, code = struct.unpack_from("<BB", events, offset)
+                args_format = "<" + INPUTS[code][1]
+                args = struct.unpack_from(args_format, events, offset + 2)
+                offset += 2 + struct.calcsize(args_format)
+                tick_events.append((tank, INPUTS[code][0], args))
+
+        keyframes = zlib.decompress(blocks[2])
+        (count,) = struct.unpack_from("<I", keyframes)
+        offset = 4
+        for i in range(count):
+            tick, length = struct.unpack_from("<II", keyframes, offset)
+            replay.keyframes[tick] = keyframes[offset + 8:offset + 8 + length]
+            offset += 8 + length
+        return replay
+
+
+def encode_state(match, boxes):
+    """ Encodes the state of the match needed to continue it from a keyframe.
+        boxes is the list of every wood and metal box created at the start of the match.
+    """
+    data = bytearray(struct.pack("<I", match.ticks))
+    for tank in match.tanks_list:
+        body = tank.body
+        data += TANK_STATE.pack(body.position.x, body.position.y, body.angle, body.velocity.x, body.velocity.y,
+                                body.angular_velocity, tank.acceleration, tank.rotation, tank.shoot_last,
+                                tank.max_speed, tank.score, tank.flag is not None)
+    for box in boxes:
+        body = box.body
+        data += BOX_STATE.pack(box in match.boxes, body.position.x, body.position.y, body.angle,
+                               body.velocity.x, body.velocity.y, body.angular_velocity)
+    data += struct.pack("<I", len(match.bullet_list))
+    for bullet in match.bullet_list:
+        body = bullet.body
+        data += BULLET_STATE.pack(body.position.x, body.position.y, body.angle,
+                                  body.velocity.x, body.velocity.y, body.angular_velocity,
+                                  bullet.expires - match.bullets.ticks)
+    flag = match.flag
+    data += FLAG_STATE.pack(flag.x, flag.y, flag.orientation, flag.is_on_tank)
+    return bytes(data)
+
+
+def restore_state(match, boxes, data):
+    """ Puts a match freshly created by Replay.create_match in the state encoded by encode_state. """
+    def set_body(body, x, y, angle, vx, vy, angular_velocity):
+        body.position = x, y
+        body.angle = angle
+        body.velocity = vx, vy
+        body.angular_velocity = angular_velocity
+
+    (match.ticks,) = struct.unpack_from("<I", data)
+    offset = 4
+    for tank in match.tanks_list:
+        state = TANK_STATE.unpack_from(data, offset)
+        offset += TANK_STATE.size
+        set_body(tank.body, *state[:6])
+        tank.acceleration, tank.rotation, tank.shoot_last, tank.max_speed, tank.score, has_flag = state[6:]
+        tank.flag = match.flag if has_flag else None
+
+    for box in boxes:
+        state = BOX_STATE.unpack_from(data, offset)
+        offset += BOX_STATE.size
+        if not state[0]:
+            match.space.remove(box.shape, box.body)
+            match.game_objects.remove(box)
+            match.boxes.remove(box)
+        else:
+            set_body(box.body, *state[1:])
+            match.moving_boxes[box] = True
+    match.update_box_tiles()
+
+    (bullets,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    for i in range(bullets):
+        state = BULLET_STATE.unpack_from(data, offset)
+        offset += BULLET_STATE.size
+        bullet = match.bullets.fire(match.tanks_list[0])
+        set_body(bullet.body, *state[:6])
+        bullet.expires = match.bullets.ticks + state[6]
+
+    flag = match.flag
+    flag.x, flag.y, flag.orientation, flag.is_on_tank = FLAG_STATE.unpack_from(data, offset)
+
+
+class ReplayRecorder:
+    """ Records the inputs of every tank of a match, and a keyframe every KEYFRAME_INTERVAL ticks.
+        It must be created before the first tick of the match.
+    """
+
+    def __init__(self, match, keyframe_interval=KEYFRAME_INTERVAL):
+        if match.ticks != 0:
+            raise ValueError("A replay must be recorded from the start of the match")
+        self.match = match
+        self.keyframe_interval = keyframe_interval
+        self.replay = Replay(maps.map_to_bytes(match.current_map), match.seed, match.substeps,
+                             match.compact_world, match.spatial_hash)
+        self.boxes = match.movable_boxes()
+        self.tank_indices = {}
+        for i, tank in enumerate(match.tanks_list):
+            self.tank_indices[tank] = i
+            tank.input_listener = self.record_input
+        match.tick_listeners.append(self.record_tick)
+
+    def record_input(self, tank, name, args):
+        """ Input listener of the tanks. """
+        self.replay.events.setdefault(self.match.ticks, []).append((self.tank_indices[tank], name, args))
+
+    def record_tick(self):
+        """ Saves a keyframe when needed. A keyframe is taken after the ais
+            have decided, so it already contains some of the inputs recorded for
+            its tick; applying them again after a seek is harmless since every
+            control method only sets the state of the tank (and shoot checks
+            ability_to_shoot).
+        """
+        self.replay.ticks = self.match.ticks
+        if self.match.ticks % self.keyframe_interval == 0:
+            self.replay.keyframes[self.match.ticks] = encode_state(self.match, self.boxes)
+
+    def save(self, file):
+        self.replay.save(file)
+
+
+class ReplayPlayer:
+    """ Plays a replay back on a new match, which can be displayed or simulated headless. """
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.restart()
+
+    def restart(self):
+        """ Goes back to the start of the match. """
+        self.match = self.replay.create_match()
+        self.boxes = self.match.movable_boxes()
+
+    def finished(self):
+        return self.match.ticks >= self.replay.ticks
+
+    def apply_inputs(self):
+        """ Calls the control methods recorded for the current tick. """
+        for tank, name, args in self.replay.events.get(self.match.ticks, ()):
+            tank = self.match.tanks_list[tank]
+            if name == "shoot":
+                self.match.shoot(tank)
+            else:
+                getattr(tank, name)(*args)
+
+    def tick(self):
+        """ Applies the inputs of the current tick and runs it. Returns the tanks that scored. """
+        self.apply_inputs()
+        return self.match.tick()
+
+    def seek(self, tick):
+        """ Moves playback to the given tick, starting from the closest keyframe before it.
+            The contact cache of the physics engine is not part of the
+            keyframes, so after a seek the match can differ slightly from the recorded one.
+        """
+        keyframe = max((t for t in self.replay.keyframes if t <= tick), default=0)
+        if keyframe > self.match.ticks or tick < self.match.ticks:
+            self.restart()
+            if keyframe > 0:
+                restore_state(self.match, self.boxes, self.replay.keyframes[keyframe])
+        while self.match.ticks < tick and not self.finished():
+            self.tick()
+
+    def run_headless(self):
+        """ Plays the rest of the replay as fast as possible and returns the scores. """
+        while not self.finished():
+            self.tick()
+        # The ais decided once more after the last tick
+        self.apply_inputs()
+        return self.match.scores()
+
+    def play(self, speed=1.0, fps=60):
+        """ Displays the rest of the replay in a window, speed times faster than real time. """
+        import pygame
+        from renderer import Renderer
+        from ctf import create_background
+
+        pygame.init()
+        screen = pygame.display.set_mode(self.match.current_map.rect().size)
+        self.match.interpolate = True
+        # Enough ticks per frame for the speed, with one to spare for the frames that come late
+        max_ticks = max(engine.MAX_TICKS_PER_FRAME, math.ceil(speed * engine.FRAMERATE / fps) + 1)
+        timestep = engine.FixedTimestep(self, max_ticks_per_frame=max_ticks)
+        renderer = Renderer(screen, self.match, create_background(screen, self.match.current_map, images))
+        clock = pygame.time.Clock()
+        frame_seconds = 0.0
+        while not self.finished():
+            if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                break
+            timestep.advance(frame_seconds * speed)
+            renderer.draw(timestep.alpha)
+            frame_seconds = clock.tick(fps) / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a recorded match")
+    parser.add_argument("replay", help="replay file written by ctf.py --record")
+    parser.add_argument("--headless", action="store_true", help="simulate the replay as fast as possible without display")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed when displayed")
+    parser.add_argument("--seek", type=int, default=0, help="tick to start playback from")
+    args = parser.parse_args()
+
+    player = ReplayPlayer(Replay.load(args.replay))
+    player.seek(args.seek)
+    if args.headless:
+        scores = player.run_headless()
+        print("%d ticks, scores %s, state %s" % (player.match.ticks, scores, player.match.state_hash()))
+    else:
+        player.play(args.speed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+""" Authoritative multiplayer server. The matches are simulated like
+    headless matches, in rooms which players join by name: the first players
+    of a room control its first tanks and the ais control the others. The
+    players send the inputs of their tank and receive snapshots of the
+    match (see net.py). One process hosts every room, with non-blocking I/O
+    on a single asyncio event loop.
+
+    Usage: python server.py --host 0.0.0.0 --port 7777 --map map1 --players 2
+"""
+import argparse
+import asyncio
+import struct
+import sys
+import traceback
+from collections import OrderedDict
+
+import assets
+import engine
+import maps
+import net
+
+DEFAULT_PORT = 7777
+SNAPSHOT_INTERVAL = 2  # A snapshot is sent every SNAPSHOT_INTERVAL ticks
+SNAPSHOT_HISTORY = 32  # Number of snapshots kept as baselines of the next ones
+MAX_WRITE_BUFFER = 1 << 16  # Clients with more bytes waiting to be sent skip snapshots
+MAX_LAG = 0.25  # Seconds a room may fall behind before it stops catching up
+MAX_ROOM_NAME = 64
+
+# Inputs accepted from the players, the other control methods of the tanks are for the ais
+PLAYER_INPUTS = {"accelerate", "decelerate", "stop_moving", "turn_left", "turn_right", "stop_turning", "shoot"}
+
+
+class Connection:
+    """ A client of the server, and the inputs it sent since the last tick. """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tank = -1  # Index of the tank of the player, -1 for a spectator
+        self.acked = None  # Tick of the last snapshot received by the client
+        self.inputs = []
+        self.input_ack = 0  # Number of inputs applied, and tick the last one was applied at
+        self.input_tick = 0
+
+
+class Room:
+    """ A match and the clients playing or watching it. The match runs at
+        engine.FRAMERATE ticks per second for as long as someone is connected.
+    """
+
+    def __init__(self, name, current_map, players, seed=None):
+        self.name = name
+        self.map_data = maps.map_to_bytes(current_map)
+        self.match = engine.Match(current_map, human_players=players, seed=seed)
+        self.boxes = self.match.movable_boxes()
+        self.seats = [None] * players  # Connection playing each human tank
+        self.connections = []
+        self.history = OrderedDict()  # Tick -> quantized state sent at that tick
+        self.snapshots = 0
+        self.skipped = 0
+
+    def join(self, connection):
+        """ Gives the connection the first free tank, if any. """
+        if None in self.seats:
+            connection.tank = self.seats.index(None)
+            self.seats[connection.tank] = connection
+        self.connections.append(connection)
+
+    def leave(self, connection):
+        """ Frees the tank of the connection, which stops where it is. """
+        self.connections.remove(connection)
+        if connection.tank >= 0:
+            self.seats[connection.tank] = None
+            tank = self.match.tanks_list[connection.tank]
+            tank.stop_moving()
+            tank.stop_turning()
+
+    def apply_inputs(self):
+        """ Calls the control methods sent by the players since the last tick.
+            Every input is counted, so that the clients know which of their
+            inputs a snapshot includes, but only PLAYER_INPUTS are applied.
+        """
+        for connection in self.connections:
+            for name, args in connection.inputs:
+                connection.input_ack += 1
+                connection.input_tick = self.match.ticks
+                if name not in PLAYER_INPUTS:
+                    continue
+                tank = self.match.tanks_list[connection.tank]
+                if name == "shoot":
+                    self.match.shoot(tank)
+                else:
+                    getattr(tank, name)(*args)
+            connection.inputs.clear()
+
+    def send_snapshots(self):
+        """ Sends the current state to every client, as a delta from the last
+            snapshot it acknowledged when the server still has it. Clients
+            acknowledging the same snapshot get the same message.
+        """
+        tick = self.match.ticks
+        state = net.quantize_state(self.match, self.boxes)
+        self.history[tick] = state
+        if len(self.history) > SNAPSHOT_HISTORY:
+            self.history.popitem(last=False)
+        messages = {}
+        for connection in self.connections:
+            if connection.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                self.skipped += 1
+                continue  # It would only fall further behind
+            baseline_tick = connection.acked if connection.acked in self.history else None
+            data = messages.get(baseline_tick)
+            if data is None:
+                data = messages[baseline_tick] = net.encode_snapshot(tick, state, baseline_tick,
+                                                                     self.history.get(baseline_tick))
+            connection.writer.write(net.message(net.SNAPSHOT, net.INPUT_ACK.pack(
+                connection.input_ack, connection.input_tick) + data))
+            self.snapshots += 1
+
+    async def run(self):
+        """ Runs the match until every client has left. """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self.connections:
+            self.apply_inputs()
+            self.match.tick()
+            if self.match.ticks % SNAPSHOT_INTERVAL == 0:
+                self.send_snapshots()
+            next_tick += 1 / engine.FRAMERATE
+            delay = next_tick - loop.time()
+            if delay < -MAX_LAG:
+                # The server is overloaded, the match is slowed down rather than run in bursts
+                next_tick = loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+    def stopped(self, task):
+        """ Called when the task running the match ends. If the match failed,
+            the error is printed and the clients are disconnected rather than
+            left waiting for snapshots.
+        """
+        if task.cancelled() or task.exception() is None:
+            return
+        print("The match of room %r failed:" % self.name, file=sys.stderr)
+        traceback.print_exception(task.exception())
+        for connection in self.connections:
+            connection.writer.close()
+
+
+class Server:
+    """ Hosts rooms on current_map, created when a client joins them and
+        closed when the last one leaves. players is the number of tanks of
+        every room controlled by players.
+    """
+
+    def __init__(self, current_map, players=1, seed=None):
+        self.current_map = current_map
+        self.players = min(players, len(current_map.start_positions))
+        self.seed = seed
+        self.rooms = {}
+        self.tasks = set()
+
+    def room(self, name):
+        """ Returns the room called name, starting it if needed. """
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, self.current_map, self.players, self.seed)
+        return room
+
+    async def handle(self, reader, writer):
+        """ Talks to one client, from its JOIN message until it disconnects. """
+        connection = Connection(reader, writer)
+        room = None
+        try:
+            kind, payload = await net.read_message(reader)
+            if kind != net.JOIN or payload[:1] != bytes([net.PROTOCOL_VERSION]):
+                return
+            room = self.room(payload[1:1 + MAX_ROOM_NAME].decode(errors="replace"))
+            room.join(connection)
+            if len(room.connections) == 1:
+                task = asyncio.create_task(room.run())
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                task.add_done_callback(room.stopped)
+            writer.write(net.message(net.WELCOME, struct.pack("<b", connection.tank) + room.map_data))
+            while True:
+                kind, payload = await net.read_message(reader)
+                if kind == net.INPUT and connection.tank >= 0:
+                    connection.inputs.append(net.decode_input(payload))
+                elif kind == net.ACK:
+                    (connection.acked,) = struct.unpack("<I", payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, struct.error):
+            pass  # The client left or broke the protocol
+        finally:
+            if room is not None:
+                room.leave(connection)
+                if not room.connections:
+                    del self.rooms[room.name]
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """ Starts accepting clients and returns the asyncio server. """
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def serve_forever(args):
+    server = Server(maps.get_map(args.map), players=args.players, seed=args.seed)
+    listener = await server.serve(args.host, args.port)
+    print("Serving %s on %s" % (args.map, ", ".join(str(socket.getsockname()) for socket in listener.sockets)))
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host capture the flag matches over the network")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--map", default="map0", help="name of the map of every room")
+    parser.add_argument("--players", type=int, default=2, help="number of tanks of a room controlled by players")
+    parser.add_argument("--seed", type=int, default=None, help="random seed of the matches")
+    args = parser.parse_args()
+
+    # Nothing is drawn or played on the server
+    assets.AssetManager.use_null_backend()
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
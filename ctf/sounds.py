@@ -1,28 +1,101 @@
+""" Sound assets for the game
+    The sounds are loaded the first time they are played (see assets.py), and
+    are NullSounds when the mixer is not initialised.
+    The game does not play them directly but through mixer (a SoundMixer),
+    which plays what was asked for during a tick all at once.
+"""
+import weakref
 
-import pygame
-import os
+import assets
 
-main_dir = os.path.split(os.path.abspath(__file__))[0]
+manager = assets.AssetManager('data/sounds')
+
+SOUNDS = {
+    'explosion_sound': 'explosion.wav',  # Sound of an explosion
+    'flag_capture_sound': 'flag_capture.wav',  # Sound of capturing the flag
+    'movement_sound': 'movement.wav',  # Sound of a tank moving
+    'tankshot_sound': 'tankshot.wav',  # Sound of a tank shooting
+    'win_sound': 'win.wav',  # Sound of a tank shooting
+    'engine_sound': 'engineidle.mp3',
+}
+
+MAX_VOICES = 4  # Number of sounds started during one tick, the others are dropped
+MAX_INSTANCES = 2  # A sound is not started again while it plays on that many channels
+# Sounds started first when more than MAX_VOICES are asked for during a tick
+PRIORITIES = ['win_sound', 'flag_capture_sound', 'explosion_sound', 'tankshot_sound']
+LOOP_VOLUMES = {'engine_sound': 0.2}  # Volume of the sounds played in a loop, 1 by default
 
 
 def load_sound(file):
     """ Load a sound from the data/sounds directory. """
-    file = os.path.join(main_dir, 'data/sounds', file)
-    try:
-        sound = pygame.mixer.Sound(file)
-    except pygame.error:
-        raise SystemExit('Could not load sound "%s" %s' % (file, pygame.get_error()))
-    return sound
+    return manager.sound(file)
+
+
+class SoundMixer:
+    """ Plays the sounds of the game once per tick. Sounds asked for with
+        play are queued and, when the tick is flushed, every sound is started
+        at most once, at most max_voices of them (by PRIORITIES), and not while
+        it already plays on max_instances channels. Looping sounds are held by
+        owners (the tanks) and only started or stopped when the first owner
+        holds them or the last one releases them, so that a tank steering the
+        same way every tick does not touch the mixer.
+    """
+
+    def __init__(self, max_voices=MAX_VOICES, max_instances=MAX_INSTANCES):
+        self.max_voices = max_voices
+        self.max_instances = max_instances
+        self.queued = set()  # Names of the sounds asked for during the current tick
+        self.holders = {}  # Name of a looping sound -> owners holding it
+        self.looping = set()  # Names of the looping sounds being played
+        self.played = 0
+        self.dropped = 0
 
+    def play(self, name):
+        """ Plays the sound name once, when the current tick is flushed. """
+        self.queued.add(name)
 
-explosion_sound = load_sound('explosion.wav')  # Sound of an explosion
+    def hold(self, name, owner, held=True):
+        """ Plays the sound name in a loop as long as an owner holds it. """
+        holders = self.holders.get(name)
+        if holders is None:
+            # Owners of finished matches must not be kept alive
+            holders = self.holders[name] = weakref.WeakSet()
+        if held:
+            holders.add(owner)
+        else:
+            holders.discard(owner)
 
-flag_capture_sound = load_sound('flag_capture.wav')  # Sound of capturing the flag
+    def flush(self):
+        """ Starts the sounds queued during the tick and starts or stops the looping sounds whose holders changed. """
+        if self.queued:
+            voices = 0
+            for name in sorted(self.queued, key=lambda name: PRIORITIES.index(name) if name in PRIORITIES else len(PRIORITIES)):
+                sound = manager.sound(SOUNDS[name])
+                if voices >= self.max_voices or sound.get_num_channels() >= self.max_instances:
+                    self.dropped += 1
+                    continue
+                sound.play()
+                voices += 1
+                self.played += 1
+            self.queued.clear()
+        for name, holders in self.holders.items():
+            if bool(holders) == (name in self.looping):
+                continue
+            sound = manager.sound(SOUNDS[name])
+            if holders:
+                sound.set_volume(LOOP_VOLUMES.get(name, 1.0))
+                sound.play(loops=-1)
+                self.looping.add(name)
+            else:
+                sound.stop()
+                self.looping.discard(name)
 
-movement_sound = load_sound('movement.wav')  # Sound of a tank moving
 
-tankshot_sound = load_sound('tankshot.wav')  # Sound of a tank shooting
+mixer = SoundMixer()
 
-win_sound = load_sound('win.wav')  # Sound of a tank shooting
 
-engine_sound = load_sound('engineidle.mp3')
\ No newline at end of file
+def __getattr__(name):
+    """ Returns the sounds of the module, loading them on first use. """
+    if name in SOUNDS:
+        return manager.sound(SOUNDS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")